@@ -0,0 +1,375 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import datetime
+import threading
+import subprocess
+
+# Reproducible benchmarks for the inference and logging hot paths.
+#
+#   python benchmark.py [--quick] [--output results.json]
+#   python benchmark.py --baseline old.json [--tolerance 0.2]
+#
+# Workloads are generated from the intents.json patterns (with a fixed seed)
+# and from replaying the user inputs in chat_log.csv. Results are printed as
+# JSON; with --baseline, any metric that got worse by more than --tolerance
+# is reported and the exit status is 1.
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+SEED = 0
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    ordered = sorted(samples)
+    return {
+        f"p{point}_ms": round(ordered[min(len(ordered) - 1, len(ordered) * point // 100)] * 1000, 4)
+        for point in points
+    }
+
+
+def pattern_workload(intents, size, seed=SEED):
+    # Patterns as users type them: random case and trailing punctuation
+    rng = random.Random(seed)
+    patterns = [pattern for intent in intents for pattern in intent['patterns']]
+    workload = []
+    for _ in range(size):
+        text = rng.choice(patterns)
+        if rng.random() < 0.3:
+            text = text.lower()
+        if rng.random() < 0.3:
+            text += rng.choice(["?", "!", "."])
+        workload.append(text)
+    return workload
+
+
+def replay_workload(path, size):
+    with open(path, 'r', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        inputs = [row[0] for row in reader if row]
+    return [inputs[i % len(inputs)] for i in range(size)] if inputs else []
+
+
+def bench_cold_start(runs):
+    # Fresh interpreters importing chatbot: once from an existing artifact per
+    # engine, and once with an empty model directory, which pays for training.
+    results = {}
+    for engine in ("sklearn", "numpy"):
+        env = dict(os.environ, CHATBOT_ENGINE=engine)
+        timings = [_startup_report(env) for _ in range(runs)]
+        results[engine] = {stage: round(sorted(t[stage] for t in timings)[len(timings) // 2], 3)
+                           for stage in timings[0]}
+    with tempfile.TemporaryDirectory() as model_dir:
+        results["train"] = _startup_report(dict(os.environ, CHATBOT_ENGINE="sklearn", CHATBOT_MODEL_DIR=model_dir))
+    return results
+
+
+def _startup_report(env):
+    output = subprocess.run(
+        [sys.executable, os.path.join(_HERE, "chatbot.py"), "--startup-report"],
+        env=env, cwd=_HERE, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_single(chatbot, workload, replay):
+    # chatbot() latency per utterance, with the classification cache off and on.
+    # The exact pattern table is off here so the numbers stay those of the
+    # model; bench_exact_match measures it.
+    results = {}
+    maxsize, enabled = chatbot.cache.maxsize, chatbot.EXACT_MATCH
+    try:
+        chatbot.EXACT_MATCH = False
+        for name, cache_size in (("uncached", 0), ("cached", maxsize or 4096)):
+            chatbot.cache.maxsize = cache_size
+            for source, texts in (("patterns", workload), ("replay", replay)):
+                chatbot.cache.clear()
+                samples = []
+                for text in texts:
+                    start = time.perf_counter()
+                    chatbot.chatbot(text)
+                    samples.append(time.perf_counter() - start)
+                results[f"{name}_{source}"] = percentiles(samples)
+    finally:
+        chatbot.cache.maxsize, chatbot.EXACT_MATCH = maxsize, enabled
+        chatbot.cache.clear()
+    return results
+
+
+def bench_exact_match(chatbot, workload, replay):
+    # chatbot() latency with the exact pattern table on and off, classification
+    # cache disabled so every miss runs the model
+    results = {}
+    maxsize, enabled = chatbot.cache.maxsize, chatbot.EXACT_MATCH
+    try:
+        chatbot.cache.maxsize = 0
+        for name, flag in (("model_only", False), ("exact_first", True)):
+            chatbot.EXACT_MATCH = flag
+            for source, texts in (("patterns", workload), ("replay", replay)):
+                before = chatbot.exact.hits
+                samples = []
+                for text in texts:
+                    start = time.perf_counter()
+                    chatbot.chatbot(text)
+                    samples.append(time.perf_counter() - start)
+                results[f"{name}_{source}"] = percentiles(samples)
+                results[f"{name}_{source}"]["mean_ms"] = round(sum(samples) / len(samples) * 1000, 4)
+                if flag:
+                    results[f"{name}_{source}"]["hit_rate"] = round((chatbot.exact.hits - before) / len(texts), 4)
+    finally:
+        chatbot.cache.maxsize, chatbot.EXACT_MATCH = maxsize, enabled
+        chatbot.cache.clear()
+    return results
+
+
+def bench_retrieval(chatbot, workload, replay, batch_size=1000):
+    # Nearest-pattern retrieval (exact and IVF) against the classifier it was
+    # derived from: per-utterance latency, batch throughput, how often the
+    # approximate index finds the same best pattern, and held-out accuracy
+    import model_store
+    import retrieval
+
+    model = model_store.load_or_build(chatbot.file_path)
+    engines = {
+        "classifier": model,
+        "retrieval": retrieval.RetrievalEngine(model),
+        "retrieval_ivf": retrieval.RetrievalEngine(model, approximate=True),
+    }
+    texts = workload[:len(workload) // 2] + replay[:len(workload) // 2]
+    results = {}
+    for name, engine in engines.items():
+        samples = []
+        for text in texts:
+            start = time.perf_counter()
+            engine.classify([text])
+            samples.append(time.perf_counter() - start)
+        results[name] = percentiles(samples)
+        batch = (texts * (batch_size // len(texts) + 1))[:batch_size]
+        start = time.perf_counter()
+        engine.classify(batch)
+        results[name]["batch_items_per_s"] = round(batch_size / (time.perf_counter() - start), 1)
+
+    exact = [matches[0][0] for matches in engines["retrieval"].nearest(texts)]
+    approximate = [matches[0][0] for matches in engines["retrieval_ivf"].nearest(texts)]
+    results["retrieval_ivf"]["recall_at_1"] = round(sum(a == b for a, b in zip(exact, approximate)) / len(texts), 4)
+    results["heldout_accuracy"] = retrieval.heldout_accuracy()
+    return results
+
+
+def bench_batch(chatbot, workload, sizes, min_runs=5, min_seconds=0.5):
+    # chatbot_batch() throughput in utterances per second by batch size, with
+    # the exact pattern table off as in bench_single. Each size is repeated
+    # at least min_runs times and for min_seconds, and the fastest run is
+    # reported, the one least disturbed by the rest of the machine; a single
+    # run of a small batch is too short to compare.
+    results = {}
+    enabled = chatbot.EXACT_MATCH
+    try:
+        chatbot.EXACT_MATCH = False
+        for size in sizes:
+            texts = (workload * (size // len(workload) + 1))[:size]
+            timings = []
+            deadline = time.perf_counter() + min_seconds
+            while len(timings) < min_runs or time.perf_counter() < deadline:
+                start = time.perf_counter()
+                chatbot.chatbot_batch(texts, chunk_size=1000)
+                timings.append(time.perf_counter() - start)
+            elapsed = min(timings)
+            results[str(size)] = {"items_per_s": round(size / elapsed, 1), "us_per_item": round(elapsed / size * 1e6, 2),
+                                  "runs": len(timings)}
+    finally:
+        chatbot.EXACT_MATCH = enabled
+    return results
+
+
+def bench_logging(rows_per_writer, writers):
+    # chat_log.csv appends with several concurrent writer threads, through
+    # ChatLogger and through the old open/append/close per message
+    from chat_logger import ChatLogger, CsvLogSink
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "chat_log.csv")
+        logger = ChatLogger(CsvLogSink(path), max_queue=rows_per_writer * writers)
+
+        def buffered(writer):
+            for i in range(rows_per_writer):
+                logger.log(f"writer {writer} message {i}", "response")
+
+        log_elapsed, total_elapsed = _run_writers(buffered, writers, after=logger.flush)
+        logger.close()
+        results["buffered"] = {
+            "log_call_rows_per_s": round(rows_per_writer * writers / log_elapsed, 1),
+            "durable_rows_per_s": round(rows_per_writer * writers / total_elapsed, 1),
+            "dropped": logger.dropped,
+        }
+
+        legacy_path = os.path.join(directory, "legacy_log.csv")
+        lock = threading.Lock()
+
+        def legacy(writer):
+            for i in range(rows_per_writer):
+                timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                with lock, open(legacy_path, 'a', newline='', encoding='utf-8') as csvfile:
+                    csv.writer(csvfile).writerow([f"writer {writer} message {i}", "response", timestamp])
+
+        _, legacy_elapsed = _run_writers(legacy, writers)
+        results["per_message_open"] = {"rows_per_s": round(rows_per_writer * writers / legacy_elapsed, 1)}
+    return results
+
+
+def _run_writers(target, writers, after=None):
+    threads = [threading.Thread(target=target, args=(writer,)) for writer in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log_elapsed = time.perf_counter() - start
+    if after is not None:
+        after()
+    return log_elapsed, time.perf_counter() - start
+
+
+def bench_history(sizes, page_size=20):
+    # Time to serve Conversation History pages as the log grows, against
+    # reading the whole CSV the way the page used to
+    from chat_history import ChatHistory
+
+    results = {}
+    base = datetime.datetime(2024, 1, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f"chat_log_{size}.csv")
+            with open(path, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(['User Input', 'Chatbot Response', 'Timestamp'])
+                for i in range(size):
+                    timestamp = (base + datetime.timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S")
+                    writer.writerow([f"message {i}", "response", timestamp])
+
+            history = ChatHistory(path)
+            start = time.perf_counter()
+            history.refresh()
+            index_build = time.perf_counter() - start
+
+            reopened = ChatHistory(path)
+            start = time.perf_counter()
+            reopened.page(0, page_size)
+            first_page = time.perf_counter() - start
+
+            start = time.perf_counter()
+            reopened.page(size // page_size // 2, page_size)
+            middle_page = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(path, 'r', encoding='utf-8') as csvfile:
+                rows = list(csv.reader(csvfile))[1:]
+            full_read = time.perf_counter() - start
+
+            results[str(size)] = {
+                "index_build_ms": round(index_build * 1000, 3),
+                "first_page_ms": round(first_page * 1000, 3),
+                "middle_page_ms": round(middle_page * 1000, 3),
+                "full_read_ms": round(full_read * 1000, 3),
+                "rows": len(rows),
+            }
+    return results
+
+
+def run(quick=False, sections=None):
+    os.chdir(_HERE)
+    import chatbot
+
+    intents = chatbot.intents
+    single_size = 500 if quick else 5000
+    workload = pattern_workload(intents, single_size)
+    replay = replay_workload(os.path.join(_HERE, "chat_log.csv"), single_size)
+
+    benchmarks = {
+        "cold_start": lambda: bench_cold_start(runs=1 if quick else 3),
+        "single": lambda: bench_single(chatbot, workload, replay),
+        "exact_match": lambda: bench_exact_match(chatbot, workload, replay),
+        "retrieval": lambda: bench_retrieval(chatbot, workload, replay),
+        "batch": lambda: bench_batch(chatbot, workload, [1, 10, 100, 1000] if quick else [1, 10, 100, 1000, 10000]),
+        "logging": lambda: bench_logging(rows_per_writer=500 if quick else 5000, writers=8),
+        "history": lambda: bench_history([1000, 10000] if quick else [1000, 10000, 100000]),
+    }
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "engine": os.environ.get("CHATBOT_ENGINE", "sklearn"),
+            "model_version": chatbot.model.version,
+            "quick": quick,
+        }
+    }
+    for name, benchmark in benchmarks.items():
+        if sections and name not in sections:
+            continue
+        results[name] = benchmark()
+    return results
+
+
+# Metrics where a larger value is better; everything else ending in _ms or
+# _us_per_item is better when smaller
+_HIGHER_IS_BETTER = ("_per_s",)
+
+
+def compare(baseline, current, tolerance, prefix=""):
+    # Regressions of current against baseline, as (metric, old, new) tuples
+    regressions = []
+    for key, new in current.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        name = f"{prefix}{key}"
+        if key == "meta" or old is None:
+            continue
+        if isinstance(new, dict):
+            regressions.extend(compare(old, new, tolerance, f"{name}."))
+        elif isinstance(new, (int, float)) and isinstance(old, (int, float)) and old > 0:
+            if key.endswith(_HIGHER_IS_BETTER):
+                worse = new < old * (1 - tolerance)
+            elif key.endswith(("_ms", "us_per_item")) or key in ("total", "imports", "intents_load", "model_load"):
+                worse = new > old * (1 + tolerance)
+            else:
+                continue
+            if worse:
+                regressions.append((name, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot inference and logging paths.")
+    parser.add_argument("--quick", action="store_true", help="smaller workloads for a fast check")
+    parser.add_argument("--only", action="append", help="run only this section (repeatable)")
+    parser.add_argument("--output", help="write the JSON results to this file as well")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown (default 0.2)")
+    args = parser.parse_args()
+
+    results = run(quick=args.quick, sections=args.only)
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(baseline, results, args.tolerance)
+        for name, old, new in regressions:
+            print(f"regression: {name}: {old} -> {new}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
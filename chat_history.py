@@ -0,0 +1,213 @@
+import io
+import os
+import csv
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from chat_logger import LOG_PATH
+
+# Size of one entry in the .idx sidecar (unsigned 64-bit byte offsets)
+_OFFSET_SIZE = array('Q').itemsize
+# New offsets are written to the sidecar in blocks of this many entries
+_INDEX_BLOCK = 65536
+
+
+class ChatHistory:
+    # Read side of chat_log.csv for the Conversation History page.
+    #
+    # A sidecar file (chat_log.csv.idx) keeps the byte offset at which every
+    # record starts, plus the end of the last complete record. It is extended
+    # incrementally as the log grows, so showing a page only reads the index
+    # tail and the bytes of the rows on that page, however large the log is.
+    # Rows are appended in time order, which lets date filters binary search
+    # the offsets instead of scanning.
+    def __init__(self, path=LOG_PATH, index_path=None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx"
+        # offsets[0] is the header row, offsets[-1] the end of the last
+        # complete record; data row i spans offsets[i + 1]:offsets[i + 2].
+        self.offsets = array('Q')
+
+    def __len__(self):
+        self.refresh()
+        return max(len(self.offsets) - 2, 0)
+
+    def refresh(self):
+        if not os.path.exists(self.path):
+            self.offsets = array('Q')
+            return
+        size = os.path.getsize(self.path)
+        if self.offsets and self.offsets[-1] == size:
+            return
+
+        with open(self.index_path, 'a+b') as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                self._load_index(index_file, size)
+                self._extend_index(index_file, size)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+
+    def _load_index(self, index_file, size):
+        # Pick up whatever another process has already indexed
+        index_file.seek(0, os.SEEK_END)
+        stored = index_file.tell() // _OFFSET_SIZE
+        if stored > len(self.offsets):
+            index_file.seek(len(self.offsets) * _OFFSET_SIZE)
+            self.offsets.frombytes(index_file.read((stored - len(self.offsets)) * _OFFSET_SIZE))
+        if len(self.offsets) > stored or (self.offsets and self.offsets[-1] > size):
+            # The log was truncated or replaced, start the index over
+            self.offsets = array('Q')
+            index_file.truncate(0)
+
+    def _extend_index(self, index_file, size, keep=True):
+        # keep=False holds on to the last offset only (LazyChatHistory)
+        new_offsets = array('Q')
+        if not self.offsets:
+            new_offsets.append(0)
+        position = self.offsets[-1] if self.offsets else 0
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(position)
+            in_quotes = False
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break  # partially written row, index it next time
+                position += len(line)
+                # A newline inside a quoted field does not end the record;
+                # escaped quotes ("") leave the parity unchanged.
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                if not in_quotes:
+                    new_offsets.append(position)
+                    if len(new_offsets) >= _INDEX_BLOCK:
+                        self._append_offsets(index_file, new_offsets, keep)
+                        new_offsets = array('Q')
+        if new_offsets:
+            self._append_offsets(index_file, new_offsets, keep)
+
+    def _append_offsets(self, index_file, new_offsets, keep):
+        index_file.seek(0, os.SEEK_END)
+        index_file.write(new_offsets.tobytes())
+        if keep:
+            self.offsets.extend(new_offsets)
+        else:
+            self.offsets = new_offsets[-1:]
+
+    def _read_rows(self, first, last):
+        # Data rows first..last-1 (oldest first) with a single seek and read
+        if first >= last:
+            return []
+        start = self.offsets[first + 1]
+        end = self.offsets[last + 1]
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(start)
+            data = log_file.read(end - start).decode('utf-8')
+        return list(csv.reader(io.StringIO(data, newline='')))
+
+    def _timestamp(self, row_number):
+        return self._read_rows(row_number, row_number + 1)[0][2]
+
+    def _bisect(self, timestamp, count):
+        # First row whose timestamp is >= the given one
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def row_range(self, start=None, end=None):
+        # Rows with start <= timestamp < end, both "YYYY-MM-DD HH:MM:SS"
+        # prefixes (a bare date works too)
+        count = len(self)
+        first = self._bisect(start, count) if start else 0
+        last = self._bisect(end, count) if end else count
+        return first, max(first, last)
+
+    def page(self, page=0, page_size=20, start=None, end=None, query=None):
+        # Newest first. Returns (rows, total); total is None for text searches,
+        # which stop reading as soon as the page is filled.
+        first, last = self.row_range(start, end)
+        if not query:
+            high = last - page * page_size
+            low = max(first, high - page_size)
+            rows = self._read_rows(low, high) if high > first else []
+            return rows[::-1], last - first
+
+        query = query.casefold()
+        skip = page * page_size
+        rows = []
+        high = last
+        while high > first and len(rows) < page_size:
+            low = max(first, high - page_size * 4)
+            for row in reversed(self._read_rows(low, high)):
+                if query in row[0].casefold() or query in row[1].casefold():
+                    if skip:
+                        skip -= 1
+                    elif len(rows) < page_size:
+                        rows.append(row)
+            high = low
+        return rows, None
+
+
+class _OffsetFile:
+    # Entries of a .idx sidecar read one at a time, in place of the offsets
+    # array
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.count = os.path.getsize(index_path) // _OFFSET_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("offset index out of range")
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(position * _OFFSET_SIZE)
+            return array('Q', index_file.read(_OFFSET_SIZE))[0]
+
+
+class LazyChatHistory(ChatHistory):
+    # ChatHistory that leaves the offset index on disk and reads the entries
+    # it needs from the .idx file. For callers that touch a few rows of a
+    # large log (analytics.chunks() takes every CHUNK_ROWS-th offset and the
+    # rows a date bisection looks at), so their memory does not grow with it.
+    def refresh(self):
+        if not os.path.exists(self.path):
+            self.offsets = array('Q')
+            return
+        size = os.path.getsize(self.path)
+        if self.offsets and self.offsets[-1] == size:
+            return
+
+        with open(self.index_path, 'a+b') as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                # Continue indexing from the last stored offset only
+                index_file.seek(0, os.SEEK_END)
+                stored = index_file.tell() // _OFFSET_SIZE
+                self.offsets = array('Q')
+                if stored:
+                    index_file.seek((stored - 1) * _OFFSET_SIZE)
+                    self.offsets.frombytes(index_file.read(_OFFSET_SIZE))
+                    if self.offsets[-1] > size:
+                        # The log was truncated or replaced
+                        self.offsets = array('Q')
+                        index_file.truncate(0)
+                self._extend_index(index_file, size, keep=False)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+        self.offsets = _OffsetFile(self.index_path)
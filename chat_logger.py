@@ -0,0 +1,174 @@
+import io
+import os
+import csv
+import time
+import sys
+import queue
+import atexit
+import datetime
+import threading
+
+import metrics
+import profiling
+
+try:
+    import fcntl
+except ImportError:  # Windows: one writer thread per process is all we get
+    fcntl = None
+
+LOG_PATH = os.path.abspath(os.environ.get("CHATBOT_LOG_PATH", "chat_log.csv"))
+LOG_HEADER = ['User Input', 'Chatbot Response', 'Timestamp']
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# "csv" appends to chat_log.csv, "segments" writes log_store.py segments
+LOG_BACKEND = os.environ.get("CHATBOT_LOG_BACKEND", "csv")
+
+# Queue markers for the writer thread
+_FLUSH = object()
+_STOP = object()
+
+
+class CsvLogSink:
+    # Appends records to chat_log.csv in its existing three column layout.
+    # Each batch is encoded up front and written with a single call while
+    # holding an exclusive lock, so rows from several processes never
+    # interleave.
+    def __init__(self, path=LOG_PATH):
+        self.path = path
+
+    def write(self, records):
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer)
+        for user_input, response, timestamp, _tag in records:
+            formatted = datetime.datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT)
+            csv_writer.writerow([user_input, response, formatted])
+
+        with open(self.path, 'a', newline='', encoding='utf-8') as csvfile:
+            if fcntl is not None:
+                fcntl.flock(csvfile, fcntl.LOCK_EX)
+            try:
+                # Write the column names when the file is new (or empty)
+                if csvfile.seek(0, os.SEEK_END) == 0:
+                    csv.writer(csvfile).writerow(LOG_HEADER)
+                csvfile.write(buffer.getvalue())
+                csvfile.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(csvfile, fcntl.LOCK_UN)
+
+
+class ChatLogger:
+    # Conversation logger with a bounded in-memory queue and a background
+    # writer thread. log() never blocks: records are batched and handed to the
+    # sink when batch_size is reached or flush_interval seconds have passed.
+    # If the queue is full the record is counted in `dropped` instead of
+    # stalling the response.
+    def __init__(self, sink=None, max_queue=10000, batch_size=256, flush_interval=1.0):
+        self.sink = sink or CsvLogSink()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="chat-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @profiling.profiled("log")
+    def log(self, user_input, response, timestamp=None, tag=None):
+        start = time.perf_counter()
+        record = (str(user_input), str(response), timestamp or time.time(), tag)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("log_dropped")
+        metrics.observe("log_write", time.perf_counter() - start)
+
+    def flush(self):
+        # Block until everything logged so far has been handed to the sink;
+        # the marker makes the writer hand over its partial batch right away
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        if hasattr(self.sink, "close"):
+            self.sink.close()
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    record = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is _FLUSH or record is _STOP:
+                    self._queue.task_done()
+                    stopping = record is _STOP
+                    break
+                batch.append(record)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._write(batch)
+
+    @profiling.profiled("log_flush")
+    def _write(self, batch):
+        try:
+            start = time.perf_counter()
+            self.sink.write(batch)
+            metrics.observe("log_flush", time.perf_counter() - start)
+            metrics.inc("log_rows", len(batch))
+            self.written += len(batch)
+        except Exception as exc:
+            self.errors += len(batch)
+            print(f"chat_logger: failed to write {len(batch)} rows: {exc!r}", file=sys.stderr)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_logger():
+    # One logger (and so one writer thread) per process
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            if LOG_BACKEND == "segments":
+                from log_store import SegmentLogSink
+                _logger = ChatLogger(SegmentLogSink())
+            else:
+                _logger = ChatLogger()
+        return _logger
+
+
+def _reset_after_fork():
+    # The writer thread does not survive fork; a forked worker starts its own
+    global _logger, _logger_lock
+    _logger = None
+    _logger_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,120 +1,382 @@
+import time
+
+# Startup timing breakdown, reported by `python chatbot.py --startup-report`
+_startup_start = time.perf_counter()
+startup_timings = {}
+
 import os
+import sys
 import json
+import argparse
 import datetime
-import csv
-import nltk
-import ssl
-import streamlit as st
 import random
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
+import model_store
+import metrics
+import profiling
+from response_cache import ClassificationCache, normalize_text
+from exact_match import ExactMatcher
+from chat_logger import LOG_BACKEND, LOG_PATH, get_logger
+from chat_history import ChatHistory
+
+startup_timings['imports'] = time.perf_counter() - _startup_start
+
+if __name__ == '__main__' and '--startup-report' not in sys.argv:
+    # `streamlit run chatbot.py` executes this file from the top on every
+    # interaction. Hand over to the imported module instead: it stays in
+    # sys.modules between reruns, so the model, cache, logger and watcher are
+    # created once per process rather than once per rerun.
+    import streamlit as st
+    import chatbot
+    chatbot.main()
+    st.stop()
+
+
+def ensure_nltk_data(download=False):
+    # nltk is not used on the inference path, so it is only imported when
+    # asked for. The local ./nltk_data directory is checked first and punkt is
+    # only downloaded when it is missing there and a download was requested.
+    import nltk
+
+    nltk.data.path.append(os.path.abspath("nltk_data"))
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        if download:
+            nltk.download('punkt', download_dir=os.path.abspath("nltk_data"))
+
 
-ssl._create_default_https_context = ssl._create_unverified_context
-nltk.data.path.append(os.path.abspath("nltk_data"))
-nltk.download('punkt')
+# Offline by default; set CHATBOT_NLTK_DOWNLOAD=1 to fetch punkt at startup
+if os.environ.get("CHATBOT_NLTK_DOWNLOAD") == "1":
+    ensure_nltk_data(download=True)
 
-# Load intents from the JSON file
+# Load the intents, validated and deduplicated, from the bundle compiled
+# from intents.json (see intents_compiler.py)
+_stage_start = time.perf_counter()
 file_path = os.path.abspath("./intents.json")
-with open(file_path, "r") as file:
-    intents = json.load(file)
-
-# Create the vectorizer and classifier
-vectorizer = TfidfVectorizer(ngram_range=(1, 4))
-clf = LogisticRegression(random_state=0, max_iter=10000)
-
-# Preprocess the data
-tags = []
-patterns = []
-for intent in intents:
-    for pattern in intent['patterns']:
-        tags.append(intent['tag'])
-        patterns.append(pattern)
-
-# training the model
-x = vectorizer.fit_transform(patterns)
-y = tags
-clf.fit(x, y)
+intents = model_store.load_intents(file_path)
+startup_timings['intents_load'] = time.perf_counter() - _stage_start
+
+# Load the trained model, training it only if intents.json changed since the
+# artifact was built (see model_store.py)
+# CHATBOT_ENGINE=numpy serves from the exported NumPy-only scorer, which
+# does not import scikit-learn (see scorer.py); CHATBOT_ENGINE=retrieval
+# answers with the tag of the most similar pattern (see retrieval.py)
+def load_model():
+    engine = os.environ.get("CHATBOT_ENGINE")
+    if engine == "numpy":
+        import scorer
+        return scorer.load_or_export(file_path)
+    if engine == "retrieval":
+        import retrieval
+        return retrieval.load_or_build(file_path)
+    return model_store.load_or_build(file_path)
+
+
+# Inputs that are literally one of the patterns skip the classifier
+# (see exact_match.py); CHATBOT_EXACT_MATCH=0 turns the fast path off
+EXACT_MATCH = os.environ.get("CHATBOT_EXACT_MATCH", "1") != "0"
+
+
+def set_model(new_model, new_intents=None):
+    # Swap the live model. Requests read the `model` reference once and keep
+    # using that object, so the ones in flight finish on the old model.
+    global model, vectorizer, clf, model_loaded_at, exact
+    exact = ExactMatcher(new_intents or intents, new_model.tag_index, new_model.version)
+    model = new_model
+    model_loaded_at = datetime.datetime.now()
+    vectorizer = getattr(new_model, 'vectorizer', None)
+    clf = getattr(new_model, 'clf', None)
+
+
+def reload_model():
+    # Load the artifact for the current intents.json, building it if needed
+    # (from the previous one with CHATBOT_INCREMENTAL=1), and make it live.
+    # Then drop the artifacts of older versions, except the one an
+    # incremental build started from.
+    global intents
+    new_intents = model_store.load_intents(file_path)
+    set_model(load_model(), new_intents)
+    intents = new_intents
+    try:
+        model_store.prune([model.version] + getattr(model, 'lineage', [])[-1:])
+    except OSError as exc:
+        print(f"could not remove old model artifacts: {exc!r}", file=sys.stderr)
+    return model
+
+
+_stage_start = time.perf_counter()
+set_model(load_model())
+startup_timings['model_load'] = time.perf_counter() - _stage_start
+startup_timings['total'] = time.perf_counter() - _startup_start
+
+# Cache of (class id, probability) per normalized input, in front of the
+# classifier. CHATBOT_CACHE_SIZE=0 disables it, CHATBOT_CACHE_TTL is in seconds.
+cache = ClassificationCache(
+    maxsize=int(os.environ.get("CHATBOT_CACHE_SIZE", "4096")),
+    ttl=float(os.environ.get("CHATBOT_CACHE_TTL", "0")) or None,
+)
+
+# Predictions whose probability is below the threshold get the fallback
+# response instead. Off (0) by default; on the current intents the patterns
+# themselves score above ~0.0087 and unrelated input around 0.007.
+CONFIDENCE_THRESHOLD = float(os.environ.get("CHATBOT_CONFIDENCE_THRESHOLD", "0"))
+FALLBACK_TAG = "fallback"
+FALLBACK_RESPONSE = "I'm not sure how to respond to that. Could you rephrase?"
+
+
+def exact_lookup(key, current):
+    # Class id when the normalized input is a known pattern, else None
+    if not EXACT_MATCH:
+        return None
+    class_id = exact.lookup(key, current.version)
+    metrics.inc("exact_misses" if class_id is None else "exact_hits")
+    return class_id
+
+
+def classify(input_text, current=None):
+    # Returns (class id, probability). Only the classification is cached, the
+    # response is still picked at random on every call. Exact pattern matches
+    # are reported with probability 1.0.
+    current = current or model
+    key = normalize_text(input_text)
+    class_id = exact_lookup(key, current)
+    if class_id is not None:
+        return class_id, 1.0
+    result = cache.get(key, current.version)
+    if result is None:
+        metrics.inc("cache_misses")
+        start = time.perf_counter()
+        x = current.transform([input_text])
+        vectorized = time.perf_counter()
+        class_ids, probabilities = current.classify_features(x)
+        metrics.observe("vectorize", vectorized - start)
+        metrics.observe("predict", time.perf_counter() - vectorized)
+        result = (int(class_ids[0]), float(probabilities[0]))
+        cache.put(key, current.version, result)
+    else:
+        metrics.inc("cache_hits")
+    return result
+
+
+def _respond(current, class_id, probability):
+    if probability < CONFIDENCE_THRESHOLD:
+        metrics.inc("fallbacks")
+        return FALLBACK_TAG, probability, FALLBACK_RESPONSE
+    return current.tags[class_id], probability, random.choice(current.class_responses[class_id])
+
+
+@profiling.profiled("reply")
+def reply(input_text):
+    # Returns (tag, probability, response) for one utterance
+    start = time.perf_counter()
+    current = model
+    class_id, probability = classify(input_text, current)
+    selected = time.perf_counter()
+    result = _respond(current, class_id, probability)
+    end = time.perf_counter()
+    metrics.observe("response", end - selected)
+    metrics.observe("reply", end - start)
+    metrics.inc("requests")
+    return result
+
 
 def chatbot(input_text):
-    input_text = vectorizer.transform([input_text])
-    tag = clf.predict(input_text)[0]
-    for intent in intents:
-        if intent['tag'] == tag:
-            response = random.choice(intent['responses'])
-            return response
-        
-counter = 0
-
-def get_response(user_input):
-    # Step 1: Predict the tag (from your model or logic)
-    tag = intent(user_input)[0]  # This could be from your ML model
-    
-    # Step 2: Check if the predicted tag is valid
-    if not tag in [intent['tag'] for intent in intents]:
-        return "I'm not sure how to respond to that. Could you rephrase?"
-    
-    # Step 3: If tag is valid, retrieve response
-    for intent in intents:
-        if intent in intent["patterns"]:
-            user_input = input(" ")
-            response = get_response(user_input)
-            return random.choice(intent['responses'])  # Choose a random response for variety
+    return reply(input_text)[2]
+
+
+def _chunks(texts, chunk_size):
+    texts = list(texts)
+    if not chunk_size:
+        chunk_size = len(texts) or 1
+    for start in range(0, len(texts), chunk_size):
+        yield texts[start:start + chunk_size]
+
+
+def _classify_chunk(current, chunk):
+    # (class id, probability) per text; only the texts that are not exact
+    # pattern matches are vectorized, together
+    results = [None] * len(chunk)
+    misses = []
+    for position, text in enumerate(chunk):
+        class_id = exact_lookup(normalize_text(text), current)
+        if class_id is None:
+            misses.append(position)
+        else:
+            results[position] = (class_id, 1.0)
+    if misses:
+        class_ids, probabilities = current.classify([chunk[position] for position in misses])
+        for position, class_id, probability in zip(misses, class_ids, probabilities):
+            results[position] = (int(class_id), float(probability))
+    return results
+
+
+def predict_tags(texts, chunk_size=None):
+    # Classify many utterances at once. chunk_size caps how many rows are
+    # vectorized together, which bounds memory for very large inputs.
+    current = model
+    tags = []
+    probabilities = []
+    for chunk in _chunks(texts, chunk_size):
+        for class_id, probability in _classify_chunk(current, chunk):
+            tags.append(current.tags[class_id])
+            probabilities.append(probability)
+    return tags, probabilities
+
+
+@profiling.profiled("batch")
+def chatbot_batch(texts, chunk_size=None):
+    # Batch version of chatbot(): returns (tag, probability, response) per text
+    current = model
+    results = []
+    for chunk in _chunks(texts, chunk_size):
+        for class_id, probability in _classify_chunk(current, chunk):
+            results.append(_respond(current, class_id, probability))
+    return results
+
+def get_response(user_input, k=3):
+    # Scoring API: returns (tag, probability, response, top_k) where top_k is
+    # [(tag, probability), ...] for the k most likely tags, best first, all
+    # from a single vectorization. Below CONFIDENCE_THRESHOLD the tag and
+    # response are the fallback ones. An exact pattern match is answered
+    # with its tag at probability 1.0, and when more than one candidate is
+    # asked for the model's ranking of the other tags follows it.
+    current = model
+    class_id = exact_lookup(normalize_text(user_input), current)
+    if class_id is not None:
+        candidates = [(current.tags[class_id], 1.0)]
+        if k > 1:
+            class_ids, probabilities = current.rank([user_input], k)
+            candidates.extend((current.tags[other], float(p))
+                              for other, p in zip(class_ids[0], probabilities[0]) if other != class_id)
+        return _respond(current, class_id, 1.0) + (candidates[:max(k, 1)],)
+    class_ids, probabilities = current.rank([user_input], k)
+    candidates = [(current.tags[class_id], float(p)) for class_id, p in zip(class_ids[0], probabilities[0])]
+    return _respond(current, class_ids[0][0], candidates[0][1]) + (candidates,)
 
 
 def main():
-    global counter
+    # Whole script rerun, recorded as the "ui_rerun" stage
+    start = time.perf_counter()
+    try:
+        _main()
+    finally:
+        metrics.observe("ui_rerun", time.perf_counter() - start)
+
+
+# Messages kept (and shown) per session; older ones stay in the chat log
+TRANSCRIPT_LIMIT = 50
+
+_history = None
+
+
+def get_history():
+    # One history reader per process, so its offset index stays in memory
+    global _history
+    if _history is None:
+        if LOG_BACKEND == "segments":
+            from log_store import LogStore
+            _history = LogStore()
+        else:
+            _history = ChatHistory(LOG_PATH)
+    return _history
+
+
+def _main():
+    import streamlit as st
+
     st.title("I am here to assist you!")
 
+    # Pick up intents.json edits without restarting (see hot_reload.py)
+    from hot_reload import start_watcher
+    start_watcher()
+
     # Create a sidebar menu with options
-    menu = ["Home", "Conversation History", "About"]
+    menu = ["Home", "Conversation History", "Stats", "About"]
     choice = st.sidebar.selectbox("Menu", menu)
+    st.sidebar.caption(f"Model {model.version[:12]}, loaded {model_loaded_at:%Y-%m-%d %H:%M:%S}")
 
     # Home Menu
     if choice == "Home":
         st.write("Welcome to the chatbot. Please enter your query and press Enter to start the conversation.")
         st.write("This chatbot helps you, if you are feeling lonely or you want to chat, Here I'm with you")
-        # Check if the chat_log.csv file exists, and if not, create it with column names
-        if not os.path.exists('chat_log.csv'):
-            with open('chat_log.csv', 'w', newline='', encoding='utf-8') as csvfile:
-                csv_writer = csv.writer(csvfile)
-                csv_writer.writerow(['User Input', 'Chatbot Response', 'Timestamp'])
-
-        counter += 1
-        user_input = st.text_input("You:", key=f"user_input_{counter}")
+        # Each session keeps its own transcript in session_state
+        transcript = st.session_state.setdefault("transcript", [])
+        user_input = st.chat_input("You:")
 
+        response = None
         if user_input:
+            tag, _, response = reply(user_input)
+            # Queue the user input and chatbot response for chat_log.csv; the
+            # background writer appends them without blocking this rerun
+            get_logger().log(user_input, response, tag=tag)
+            transcript.append(("user", user_input))
+            transcript.append(("assistant", response))
+            del transcript[:-TRANSCRIPT_LIMIT]
 
-            # Convert the user input to a string
-            user_input_str = str(user_input)
-
-            response = chatbot(user_input)
-            st.text_area("Chatbot:", value=response, height=120, max_chars=None, key=f"chatbot_response_{counter}")
-
-            # Get the current timestamp
-            timestamp = datetime.datetime.now().strftime(f"%Y-%m-%d %H:%M:%S")
-
-            # Save the user input and chatbot response to the chat_log.csv file
-            with open('chat_log.csv', 'a', newline='', encoding='utf-8') as csvfile:
-                csv_writer = csv.writer(csvfile)
-                csv_writer.writerow([user_input_str, response, timestamp])
+        if len(transcript) == TRANSCRIPT_LIMIT:
+            st.caption("Earlier messages are in the Conversation History.")
+        for role, text in transcript:
+            with st.chat_message(role):
+                st.text(text)
 
-            if response.lower() in ['goodbye', 'bye']:
-                st.write("Thank you for chatting with me. Have a great day!")
-                st.stop()
+        if response and response.lower() in ['goodbye', 'bye']:
+            st.write("Thank you for chatting with me. Have a great day!")
+            st.stop()
 
     # Conversation History Menu
     elif choice == "Conversation History":
         # Display the conversation history in a collapsible expander
         st.header("Conversation History")
         # with st.beta_expander("Click to see Conversation History"):
-        with open('chat_log.csv', 'r', encoding='utf-8') as csvfile:
-            csv_reader = csv.reader(csvfile)
-            next(csv_reader)  # Skip the header row
-            for row in csv_reader:
-                st.text(f"User: {row[0]}")
-                st.text(f"Chatbot: {row[1]}")
-                st.text(f"Timestamp: {row[2]}")
-                st.markdown("---")
+        # Make sure rows still sitting in the logger queue are on disk
+        get_logger().flush()
+        # Only the rows of the requested page are read from the log
+        history = get_history()
+        if not history:
+            st.write("No conversations yet.")
+            return
+
+        query = st.sidebar.text_input("Search")
+        dates = st.sidebar.date_input("Date range", value=())
+        page_size = st.sidebar.selectbox("Rows per page", [20, 50, 100])
+        start = end = None
+        if len(dates) == 2:
+            start = dates[0].isoformat()
+            end = (dates[1] + datetime.timedelta(days=1)).isoformat()
+        page = st.number_input("Page", min_value=1, value=1, step=1) - 1
+
+        rows, total = history.page(page, page_size, start=start, end=end, query=query)
+        if total is not None:
+            st.caption(f"{total} conversations, page {page + 1} of {max((total - 1) // page_size + 1, 1)}")
+        for row in rows:
+            st.text(f"User: {row[0]}")
+            st.text(f"Chatbot: {row[1]}")
+            st.text(f"Timestamp: {row[2]}")
+            st.markdown("---")
+
+    elif choice == "Stats":
+        # Latency per stage and counters recorded by this process
+        st.header("Stats")
+        stats = metrics.snapshot()
+        st.subheader("Latency per stage (ms)")
+        st.table({name: values for name, values in stats["stages"].items()})
+        st.subheader("Counters")
+        st.table(stats["counters"])
+        st.subheader("Cache")
+        st.table(cache.stats())
+        st.subheader("Exact matches")
+        st.table(exact.stats())
+
+        # Request profiling, for the whole process (see profiling.py)
+        rate = st.sidebar.number_input("Profile sample rate", min_value=0.0, max_value=1.0,
+                                       value=profiling.rate(), step=0.01,
+                                       help="Share of requests run under cProfile, 0 is off")
+        if rate != profiling.rate():
+            profiling.set_rate(rate)
+        if st.sidebar.button("Write profiles now"):
+            profiling.flush()
+        st.subheader("Profiling")
+        st.json(profiling.stats())
 
     elif choice == "About":
         st.write("The goal of this project is to create a chatbot that can understand and respond to user input based on intents. The chatbot is built using Natural Language Processing (NLP) library and Logistic Regression, to extract the intents and entities from user input. The chatbot is built using Streamlit, a Python library for building interactive web applications.")
@@ -144,7 +406,26 @@ def main():
 
         st.write("In this project, a chatbot is built that can understand and respond to user input based on intents. The chatbot was trained using NLP and Logistic Regression, and the interface was built using Streamlit. This project can be extended by adding more data, using more sophisticated NLP techniques, deep learning algorithms.")
 
+def startup_report(argv):
+    # Print the startup breakdown as JSON and fail when it exceeds the budget
+    # given with --max-startup-ms, so CI can gate cold-start time.
+    parser = argparse.ArgumentParser(description="Report how long the chatbot takes to start.")
+    parser.add_argument("--startup-report", action="store_true", help="print the startup timings as JSON")
+    parser.add_argument("--max-startup-ms", type=float, help="exit with 1 when startup takes longer than this")
+    # Other arguments are left to the app
+    args, _ = parser.parse_known_args(argv[1:])
+
+    timings_ms = {stage: round(seconds * 1000, 3) for stage, seconds in startup_timings.items()}
+    print(json.dumps(timings_ms))
+    if args.max_startup_ms is not None and timings_ms['total'] > args.max_startup_ms:
+        print(f"startup took {timings_ms['total']}ms, budget is {args.max_startup_ms}ms", file=sys.stderr)
+        return 1
+    return 0
+
+
 if __name__ == '__main__':
+    if '--startup-report' in sys.argv:
+        sys.exit(startup_report(sys.argv))
     main() 
 {
  "cells": [
@@ -0,0 +1,88 @@
+import sys
+import json
+import argparse
+
+from response_cache import normalize_text
+
+# Exact-match fast path in front of the classifier.
+#
+# Most real inputs ("Hi", "Thanks", "Bye") are one of the intents.json
+# patterns typed again. ExactMatcher maps every pattern, normalized the same
+# way as the classification cache keys, to the class id of its tag, so those
+# inputs are answered with one dict lookup and never reach the vectorizer.
+#
+# A normalized pattern listed under more than one tag is a conflict. It goes
+# to the tag that lists it most often, and on a tie to the tag that comes
+# first in intents.json, so the result does not depend on dict or set order.
+# `python exact_match.py` prints the conflicts.
+
+
+class ExactMatcher:
+    def __init__(self, intents, tag_index, version=None):
+        # tag_index maps tag -> class id of the model the table is built for
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        first_seen = {}
+        counts = {}
+        for position, intent in enumerate(intents):
+            first_seen.setdefault(intent['tag'], position)
+            for pattern in intent['patterns']:
+                key = normalize_text(pattern)
+                if key:
+                    tags = counts.setdefault(key, {})
+                    tags[intent['tag']] = tags.get(intent['tag'], 0) + 1
+
+        self.table = {}
+        self.conflicts = {}
+        for key, tags in counts.items():
+            ordered = sorted(tags, key=lambda tag: (-tags[tag], first_seen[tag]))
+            if len(ordered) > 1:
+                self.conflicts[key] = ordered
+            if ordered[0] in tag_index:
+                self.table[key] = tag_index[ordered[0]]
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, key, version=None):
+        # Class id for a normalized input, or None. A table built for another
+        # model version never answers, so a request that raced a model swap
+        # falls through to the classifier.
+        if version is not None and version != self.version:
+            return None
+        class_id = self.table.get(key)
+        if class_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return class_id
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "patterns": len(self.table),
+            "conflicts": len(self.conflicts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List patterns that appear under more than one tag.")
+    parser.add_argument("--intents", default="intents.json", help="path to intents.json")
+    args = parser.parse_args()
+
+    with open(args.intents, "r") as file:
+        intents = json.load(file)
+    tags = {intent['tag'] for intent in intents}
+    matcher = ExactMatcher(intents, {tag: tag for tag in tags})
+    for key, ordered in sorted(matcher.conflicts.items()):
+        print(f"{key!r}: {ordered[0]} (also {', '.join(ordered[1:])})")
+    print(f"{len(matcher.table)} patterns, {len(matcher.conflicts)} conflicts", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
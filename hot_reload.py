@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+import subprocess
+
+import chatbot
+import model_store
+
+# Polling interval in seconds; CHATBOT_WATCH_INTERVAL=0 turns the watcher off
+WATCH_INTERVAL = float(os.environ.get("CHATBOT_WATCH_INTERVAL", "2"))
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class ModelWatcher(threading.Thread):
+    # Watches intents.json and swaps in a new model when its content changes.
+    #
+    # The mtime and size are polled every `interval` seconds and the file is
+    # only hashed when they move. The artifact is built in a child process, so
+    # training neither runs on a request thread nor competes for this
+    # process's GIL; the finished artifact is then loaded here and made live
+    # with chatbot.set_model(). If anything fails the current model stays.
+    def __init__(self, path=None, interval=WATCH_INTERVAL):
+        super().__init__(name="model-watcher", daemon=True)
+        self.path = path or chatbot.file_path
+        self.interval = interval
+        self.reloads = 0
+        self.last_error = None
+        self._stop_event = threading.Event()
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            self.check()
+
+    def check(self):
+        try:
+            if model_store.intents_hash(self.path) == chatbot.model.version:
+                return False
+            self.build()
+            chatbot.reload_model()
+            self.reloads += 1
+            self.last_error = None
+            return True
+        except subprocess.CalledProcessError as exc:
+            # The build's own stderr says why, e.g. the IntentsError problems
+            details = (exc.stderr or b"").decode("utf-8", "replace").strip()
+            return self._failed(f"{exc!r}\n{details}" if details else repr(exc))
+        except Exception as exc:
+            return self._failed(repr(exc))
+
+    def _failed(self, error):
+        self.last_error = error
+        print(f"model reload failed, keeping {chatbot.model.version[:16]}: {error}", file=sys.stderr)
+        return False
+
+    def build(self):
+        script = "scorer.py" if os.environ.get("CHATBOT_ENGINE") == "numpy" else "model_store.py"
+        subprocess.run(
+            [sys.executable, os.path.join(_HERE, script), "--intents", self.path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def start_watcher(interval=WATCH_INTERVAL):
+    # One watcher per process; returns None when watching is disabled
+    global _watcher
+    if interval <= 0:
+        return None
+    with _watcher_lock:
+        if _watcher is None or not _watcher.is_alive():
+            _watcher = ModelWatcher(interval=interval)
+            _watcher.start()
+        return _watcher
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import pickle
+import argparse
+
+import model_store
+from response_cache import normalize_text
+
+# Compile step for intents.json.
+#
+# intents.json is edited by hand, so it is checked before anything trains or
+# serves from it:
+#   * every entry must be an object with a non-empty "tag" string and
+#     non-empty "patterns" and "responses" lists of non-empty strings;
+#     anything else is an error and the compile fails
+#   * entries repeating a tag are merged into the first one, keeping the
+#     patterns and responses of all of them in file order
+#   * patterns repeated within a tag (after case, spacing and punctuation
+#     folding) are dropped
+#   * patterns listed under several tags are reported as conflicts; with
+#     --strict they fail the compile too
+#
+# The result is pickled as an IntentBundle next to the model artifacts, keyed
+# by the same hash of intents.json: parallel tuples of tags, patterns and
+# responses, one entry per tag in intents.json order. That order is kept
+# because it decides pattern conflicts (see exact_match.py); the model's class
+# ids are the sorted tags and ChatModel keeps its own index. Equal strings are
+# interned before pickling, so each is stored and loaded once.
+#
+# A bundle is identified by source_hash, the intents.json hash that also keys
+# the model artifacts, rather than by a hash of its compiled contents:
+# nothing compares bundles by content, and an edit that compiles to the same
+# tables (reordered keys, whitespace) only costs one recompile.
+#
+#   python intents_compiler.py [--intents intents.json] [--strict]
+
+BUNDLE_FORMAT = 2
+
+
+class IntentsError(ValueError):
+    def __init__(self, problems):
+        super().__init__(f"{len(problems)} problem(s) in intents.json:\n  " + "\n  ".join(problems))
+        self.problems = problems
+
+
+def _strings(value):
+    return isinstance(value, list) and value and all(isinstance(item, str) and item.strip() for item in value)
+
+
+def validate(intents):
+    problems = []
+    if not isinstance(intents, list):
+        return ["the top level must be a list of intents"]
+    for position, intent in enumerate(intents):
+        where = f"entry {position}"
+        if not isinstance(intent, dict):
+            problems.append(f"{where}: not an object")
+            continue
+        tag = intent.get("tag")
+        if not isinstance(tag, str) or not tag.strip():
+            problems.append(f"{where}: missing or empty tag")
+        else:
+            where = f"entry {position} ({tag})"
+        for key in ("patterns", "responses"):
+            if not _strings(intent.get(key)):
+                problems.append(f"{where}: {key} must be a non-empty list of non-empty strings")
+        unknown = set(intent) - {"tag", "patterns", "responses"}
+        if unknown:
+            problems.append(f"{where}: unknown keys {', '.join(sorted(unknown))}")
+    return problems
+
+
+def compile_intents(intents, strict=False):
+    # Returns (tags, patterns per class, responses per class, notes). Raises
+    # IntentsError for invalid input, and for conflicts when strict.
+    problems = validate(intents)
+    if problems:
+        raise IntentsError(problems)
+
+    tags = []
+    patterns = []
+    responses = []
+    class_ids = {}
+    seen = []
+    notes = []
+    for intent in intents:
+        tag = intent["tag"]
+        if tag in class_ids:
+            notes.append(f"merged repeated tag {tag!r}")
+        else:
+            class_ids[tag] = len(tags)
+            tags.append(tag)
+            patterns.append([])
+            responses.append([])
+            seen.append(set())
+        class_id = class_ids[tag]
+        for pattern in intent["patterns"]:
+            key = normalize_text(pattern)
+            if key in seen[class_id]:
+                notes.append(f"dropped duplicate pattern {pattern!r} of {tag!r}")
+                continue
+            seen[class_id].add(key)
+            patterns[class_id].append(pattern)
+        for response in intent["responses"]:
+            if response not in responses[class_id]:
+                responses[class_id].append(response)
+
+    owners = {}
+    for class_id, keys in enumerate(seen):
+        for key in keys:
+            owners.setdefault(key, []).append(tags[class_id])
+    conflicts = [f"pattern {key!r} is listed under {', '.join(owner)}"
+                 for key, owner in sorted(owners.items()) if len(owner) > 1]
+    if strict and conflicts:
+        raise IntentsError(conflicts)
+    return tags, patterns, responses, notes + conflicts
+
+
+class IntentBundle:
+    def __init__(self, tags, patterns, responses, source_hash):
+        # Equal strings are made one object, which pickle then writes once
+        interned = {}
+        self.tags = tuple(interned.setdefault(tag, tag) for tag in tags)
+        self.patterns = tuple(tuple(interned.setdefault(p, p) for p in group) for group in patterns)
+        self.responses = tuple(tuple(interned.setdefault(r, r) for r in group) for group in responses)
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __reduce__(self):
+        return (_restore, (BUNDLE_FORMAT, self.tags, self.patterns, self.responses, self.source_hash))
+
+    def as_intents(self):
+        # The intents.json layout, one entry per tag, for code that walks it;
+        # the pattern and response tuples are shared, not copied
+        return [{"tag": tag, "patterns": patterns, "responses": responses}
+                for tag, patterns, responses in zip(self.tags, self.patterns, self.responses)]
+
+
+def _restore(bundle_format, *fields):
+    # The format is checked before the fields are unpacked, since their
+    # number may differ between formats
+    if bundle_format != BUNDLE_FORMAT:
+        raise ValueError(f"unsupported intents bundle format {bundle_format!r}")
+    bundle = IntentBundle.__new__(IntentBundle)
+    bundle.tags, bundle.patterns, bundle.responses, bundle.source_hash = fields
+    return bundle
+
+
+def bundle_path(version, model_dir=model_store.MODEL_DIR):
+    return os.path.join(model_dir, f"intents-{version[:16]}.bundle")
+
+
+def compile_file(intents_path=model_store.INTENTS_PATH, path=None, strict=False):
+    # Compile intents.json and write the bundle; returns (path, notes)
+    version = model_store.intents_hash(intents_path)
+    path = path or bundle_path(version)
+    with open(intents_path, "r", encoding="utf-8") as file:
+        try:
+            intents = json.load(file)
+        except json.JSONDecodeError as exc:
+            raise IntentsError([f"not valid JSON: {exc}"]) from None
+    tags, patterns, responses, notes = compile_intents(intents, strict)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        pickle.dump(IntentBundle(tags, patterns, responses, version), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return path, notes
+
+
+def read_bundle(path):
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def load(intents_path=model_store.INTENTS_PATH, model_dir=model_store.MODEL_DIR):
+    # Bundle for the current intents.json, compiling it only when it changed
+    version = model_store.intents_hash(intents_path)
+    path = bundle_path(version, model_dir)
+    if not os.path.exists(path):
+        compile_file(intents_path, path)
+    try:
+        bundle = read_bundle(path)
+    except (ValueError, pickle.UnpicklingError, EOFError):
+        bundle = None
+    if bundle is None or bundle.source_hash != version:
+        # Stale, foreign or older format file under our name
+        compile_file(intents_path, path)
+        bundle = read_bundle(path)
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate intents.json and compile it into a bundle.")
+    parser.add_argument("--intents", default=model_store.INTENTS_PATH, help="path to intents.json")
+    parser.add_argument("--model-dir", default=model_store.MODEL_DIR, help="directory for the bundle")
+    parser.add_argument("--strict", action="store_true", help="fail on patterns listed under several tags")
+    args = parser.parse_args()
+
+    # Go through the importable module so the pickle refers to
+    # intents_compiler rather than __main__
+    import intents_compiler
+
+    version = model_store.intents_hash(args.intents)
+    try:
+        path, notes = intents_compiler.compile_file(args.intents, bundle_path(version, args.model_dir), args.strict)
+    except intents_compiler.IntentsError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    for note in notes:
+        print(note, file=sys.stderr)
+    bundle = intents_compiler.read_bundle(path)
+    print(f"{path}: {len(bundle)} tags, {sum(map(len, bundle.patterns))} patterns")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+from benchmark import pattern_workload, replay_workload, percentiles
+
+# Concurrent-session load generator for the chat path.
+#
+#   python loadgen.py --target inprocess --sessions 1,4,16,64 --duration 20 --think 1.0
+#   python loadgen.py --target streamlit --sessions 1,2,4,8
+#   python loadgen.py --target http://127.0.0.1:8000 --pid <server pid> --sessions 8,32,128
+#
+# Each session is a thread that sends an utterance, waits for the answer and
+# then "thinks" for an exponentially distributed pause with the given mean
+# (--think 0 is a closed loop). Utterances are drawn from the intents.json
+# patterns and from replaying chat_log.csv, mixed by --replay-share.
+#
+# Targets:
+#   inprocess  chatbot.reply() plus the ChatLogger write, what the Home page
+#              does per message, without the Streamlit rerun around it
+#   streamlit  the real chatbot.py page through streamlit.testing's AppTest,
+#              one app session per simulated user, every message a full rerun
+#   http://..  POST /chat against a running server.py
+#
+# Every --sessions level runs for --duration seconds and reports throughput,
+# latency percentiles, errors and the RSS of the serving process sampled over
+# time. The first level whose throughput grows by less than 10% over the
+# previous one, or whose p95 exceeds --max-p95-ms, is reported as the
+# saturation point. In-process targets log to a temporary file unless
+# --log-path is given, so chat_log.csv is left alone.
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class InProcessTarget:
+    name = "inprocess"
+
+    def __init__(self):
+        import chatbot
+        from chat_logger import get_logger
+        self.chatbot = chatbot
+        self.logger = get_logger()
+        self.pids = [os.getpid()]
+
+    def session(self):
+        def send(text):
+            tag, _, response = self.chatbot.reply(text)
+            self.logger.log(text, response, tag=tag)
+        return send
+
+    def close(self):
+        self.logger.flush()
+
+
+class StreamlitTarget(InProcessTarget):
+    # AppTest compiles the script on every run, and concurrent compiles in
+    # threads can fail inside CPython's ast module, so reruns are serialized.
+    # Latency then includes waiting for the other sessions' reruns, much like
+    # queueing behind the GIL in a real Streamlit server.
+    name = "streamlit"
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def session(self):
+        from streamlit.testing.v1 import AppTest
+        app = AppTest.from_file(os.path.join(_HERE, "chatbot.py"), default_timeout=30)
+        with self._lock:
+            app.run()
+
+        def send(text):
+            with self._lock:
+                app.chat_input[0].set_value(text).run()
+            if app.exception:
+                raise RuntimeError(app.exception[0].message)
+        return send
+
+
+class HttpTarget:
+    def __init__(self, url, pids=()):
+        parts = urlsplit(url)
+        self.name = url
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.pids = list(pids)
+
+    def session(self):
+        # One keep-alive connection per simulated user
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+        def send(text):
+            try:
+                connection.request("POST", "/chat", json.dumps({"text": text}),
+                                   {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+        return send
+
+    def close(self):
+        pass
+
+
+def rss_kb(pids):
+    # Resident memory of the given processes and all their children, in kB;
+    # None where /proc is not available
+    total = 0
+    todo = list(pids)
+    seen = set()
+    while todo:
+        pid = todo.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as children:
+                    todo.extend(int(child) for child in children.read().split())
+        except OSError:
+            if pid in pids:
+                return None
+    return total
+
+
+def run_level(target, sessions, duration, think, workload, sample_interval=0.5, seed=0):
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    stop_at = start + duration
+
+    def failed(kind):
+        kind = kind[:120]
+        with lock:
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def user(number):
+        rng = random.Random(seed * 100003 + number)
+        try:
+            send = target.session()
+        except Exception as exc:
+            failed(f"session start: {exc!r}")
+            return
+        while time.perf_counter() < stop_at:
+            text = rng.choice(workload)
+            sent = time.perf_counter()
+            try:
+                send(text)
+            except Exception as exc:
+                failed(repr(exc))
+            else:
+                with lock:
+                    latencies.append(time.perf_counter() - sent)
+            if think > 0:
+                time.sleep(min(rng.expovariate(1 / think), max(stop_at - time.perf_counter(), 0)))
+
+    rss = []
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(sample_interval):
+            rss.append((round(time.perf_counter() - start, 2), rss_kb(target.pids)))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    threads = [threading.Thread(target=user, args=(number,), daemon=True) for number in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+
+    result = {
+        "sessions": sessions,
+        "seconds": round(elapsed, 2),
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "errors": sum(errors.values()),
+        "error_kinds": errors,
+    }
+    if latencies:
+        result.update(percentiles(latencies))
+        result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 4)
+    measured = [kb for _, kb in rss if kb is not None]
+    if measured:
+        result["rss_peak_kb"] = max(measured)
+        result["rss_kb"] = rss
+    return result
+
+
+def saturation(levels, max_p95_ms=None):
+    # Sessions of the first level that no longer scales, or None
+    previous = None
+    for level in levels:
+        if max_p95_ms is not None and level.get("p95_ms", float("inf")) > max_p95_ms:
+            return level["sessions"]
+        if previous and level["throughput_rps"] < previous["throughput_rps"] * 1.1:
+            return level["sessions"]
+        previous = level
+    return None
+
+
+def make_workload(size, replay_share, seed=0):
+    import model_store
+    patterns = pattern_workload(model_store.load_intents(), size, seed)
+    replay = replay_workload(os.path.join(_HERE, "chat_log.csv"), size)
+    rng = random.Random(seed)
+    return [replay[i] if replay and rng.random() < replay_share else patterns[i] for i in range(size)]
+
+
+def make_target(name, pids=()):
+    if name == "inprocess":
+        return InProcessTarget()
+    if name == "streamlit":
+        return StreamlitTarget()
+    if name.startswith("http://"):
+        return HttpTarget(name, pids)
+    raise ValueError(f"unknown target {name!r}, expected inprocess, streamlit or an http:// URL")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent chat sessions and report how the chat path holds up.")
+    parser.add_argument("--target", default="inprocess", help="inprocess, streamlit or http://host:port of server.py")
+    parser.add_argument("--sessions", default="1,4,16", help="comma separated session counts, one run each")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    parser.add_argument("--think", type=float, default=1.0, help="mean think time between messages in seconds")
+    parser.add_argument("--replay-share", type=float, default=0.5, help="share of utterances replayed from chat_log.csv")
+    parser.add_argument("--max-p95-ms", type=float, help="latency bar for the saturation point")
+    parser.add_argument("--pid", type=int, action="append", default=[],
+                        help="server process to sample RSS from, with its children (http target)")
+    parser.add_argument("--log-path", help="chat log for in-process targets (default: a temporary file)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file as well")
+    args = parser.parse_args()
+
+    if not args.target.startswith("http://"):
+        # Must be set before chat_logger is imported
+        os.environ["CHATBOT_LOG_PATH"] = args.log_path or os.path.join(tempfile.mkdtemp(), "chat_log.csv")
+        os.environ.setdefault("CHATBOT_WATCH_INTERVAL", "0")
+    try:
+        target = make_target(args.target, args.pid)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    workload = make_workload(5000, args.replay_share, args.seed)
+    levels = []
+    for sessions in (int(value) for value in args.sessions.split(",")):
+        level = run_level(target, sessions, args.duration, args.think, workload, seed=args.seed)
+        levels.append(level)
+        print(f"{sessions:>5} sessions: {level['throughput_rps']:>8} req/s  p95 {level.get('p95_ms')} ms  "
+              f"errors {level['errors']}  rss {level.get('rss_peak_kb')} kB", file=sys.stderr)
+    target.close()
+
+    results = {
+        "target": target.name,
+        "think_s": args.think,
+        "duration_s": args.duration,
+        "levels": levels,
+        "saturation_sessions": saturation(levels, args.max_p95_ms),
+    }
+    if isinstance(target, InProcessTarget):
+        results["log_path"] = os.environ["CHATBOT_LOG_PATH"]
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
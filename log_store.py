@@ -0,0 +1,383 @@
+import os
+import csv
+import sys
+import gzip
+import json
+import time
+import zlib
+import heapq
+import itertools
+import argparse
+import datetime
+
+from chat_logger import LOG_PATH, TIMESTAMP_FORMAT
+
+# Segmented conversation log: an alternative to the single chat_log.csv.
+#
+# Records are stored by column: every block is one gzip member holding a
+# JSON line with the epoch timestamps (delta encoded) and the tag, user input
+# and response columns (dictionary encoded, since the same tags, patterns and
+# responses come back over and over). Each process appends one block per
+# batch to its own open segment (`<start>-open-<pid>.jsonl.gz`), so writers
+# never share a file and a crash loses at most the batch being written. Once
+# the segment reaches SEGMENT_BYTES or spans SEGMENT_SECONDS it is sealed:
+# its small blocks are compacted into blocks of up to BLOCK_ROWS rows and it
+# is renamed to `<start>-<end>-<pid>.jsonl.gz`. The times in the names let
+# readers skip every segment outside the requested range without opening it.
+# Open segments left by processes that died are sealed the same way by the
+# next writer that starts a segment, and by this script.
+#
+#   CHATBOT_LOG_BACKEND=segments streamlit run chatbot.py
+#   python log_store.py --migrate chat_log.csv
+#   python log_store.py --start 2024-12-01 --end 2024-12-31 > december.csv
+
+LOG_DIR = os.path.abspath(os.environ.get("CHATBOT_LOG_DIR", "chat_logs"))
+SEGMENT_BYTES = int(os.environ.get("CHATBOT_LOG_SEGMENT_BYTES", 16 * 1024 * 1024))
+SEGMENT_SECONDS = int(os.environ.get("CHATBOT_LOG_SEGMENT_SECONDS", 24 * 3600))
+# Segments are read in pieces of this size
+READ_BYTES = 1024 * 1024
+BLOCK_ROWS = 65536
+SUFFIX = ".jsonl.gz"
+
+
+def _encode_column(values):
+    codes = {}
+    index = [codes.setdefault(value, len(codes)) for value in values]
+    return {"values": list(codes), "index": index}
+
+
+def _decode_column(column):
+    values = column["values"]
+    return [values[i] for i in column["index"]]
+
+
+def encode_block(records):
+    # One gzip member for (user_input, response, epoch, tag) records
+    timestamps = [int(record[2]) for record in records]
+    block = {
+        "ts": timestamps[:1] + [b - a for a, b in zip(timestamps, timestamps[1:])],
+        "tag": _encode_column([record[3] for record in records]),
+        "input": _encode_column([record[0] for record in records]),
+        "response": _encode_column([record[1] for record in records]),
+    }
+    return gzip.compress((json.dumps(block, ensure_ascii=False) + "\n").encode("utf-8"), compresslevel=6)
+
+
+def decode_blocks(data):
+    # (epoch, tag, user_input, response) tuples from concatenated blocks
+    records = []
+    for line in data.decode("utf-8").splitlines():
+        block = json.loads(line)
+        timestamps = list(itertools.accumulate(block["ts"]))
+        records.extend(zip(timestamps, _decode_column(block["tag"]),
+                           _decode_column(block["input"]), _decode_column(block["response"])))
+    return records
+
+
+class SegmentLogSink:
+    # ChatLogger sink writing rotated segments. Rotation is decided on the
+    # record timestamps, so a migration splits old logs by time the same way
+    # live logging does.
+    def __init__(self, directory=LOG_DIR, max_bytes=SEGMENT_BYTES, max_seconds=SEGMENT_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._path = None
+        self._pid = None
+        self._start = None
+        self._end = None
+
+    def write(self, records):
+        # A batch is split wherever it crosses the rotation time of the
+        # segment, so a long quiet log still ends up in one segment per
+        # SEGMENT_SECONDS rather than one segment per batch
+        position = 0
+        while position < len(records):
+            timestamp = int(records[position][2])
+            if self._path is not None and (
+                    self._pid != os.getpid()
+                    or os.path.getsize(self._path) >= self.max_bytes
+                    or timestamp - self._start >= self.max_seconds):
+                self.seal()
+            if self._path is None:
+                os.makedirs(self.directory, exist_ok=True)
+                seal_stale(self.directory)
+                self._pid = os.getpid()
+                self._start = timestamp
+                self._path = os.path.join(self.directory, f"{timestamp}-open-{self._pid}{SUFFIX}")
+
+            rotate_at = self._start + self.max_seconds
+            end = position + 1
+            while end < len(records) and int(records[end][2]) < rotate_at:
+                end += 1
+            part = records[position:end]
+            # Concatenated gzip members read back as one stream
+            with open(self._path, "ab") as segment:
+                segment.write(encode_block(part))
+            self._end = max(self._end or 0, max(int(record[2]) for record in part))
+            position = end
+
+    def seal(self):
+        if self._path is None:
+            return
+        if self._pid == os.getpid():
+            sealed = os.path.join(self.directory, f"{self._start}-{self._end}-{self._pid}{SUFFIX}")
+            compact(self._path, sealed)
+        self._path = self._pid = self._start = self._end = None
+
+    def close(self):
+        self.seal()
+
+
+def read_members(path):
+    # Records of one segment file, decoded a member at a time as the file is
+    # read. An open segment may end in a block that is still being written,
+    # or was cut short by a crash, so reading stops at the first incomplete
+    # member.
+    try:
+        segment = open(path, "rb")
+    except FileNotFoundError:
+        return  # sealed (renamed) since it was listed
+    with segment:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        chunks = []
+        data = b""
+        while True:
+            if not data:
+                data = segment.read(READ_BYTES)
+                if not data:
+                    return
+            try:
+                chunks.append(decompressor.decompress(data))
+            except zlib.error:
+                return
+            if not decompressor.eof:
+                data = b""
+                continue
+            yield from decode_blocks(b"".join(chunks))
+            chunks = []
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+def compact(path, sealed):
+    # Rewrite the per-batch blocks of an open segment as large ones, which
+    # compress much better, then swap the result in under the sealed name
+    records = [(user_input, response, timestamp, tag)
+               for timestamp, tag, user_input, response in read_members(path)]
+    if records:
+        tmp_path = f"{sealed}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as segment:
+            for start in range(0, len(records), BLOCK_ROWS):
+                segment.write(encode_block(records[start:start + BLOCK_ROWS]))
+        os.replace(tmp_path, sealed)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # another process sealed it first
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def seal_stale(directory=LOG_DIR):
+    # Seal the open segments of processes that died without closing their
+    # logger; otherwise they stay uncompacted and every scan reads them
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    sealed = 0
+    for name in names:
+        if not name.endswith(SUFFIX) or "-open-" not in name:
+            continue
+        start, _, pid = name[:-len(SUFFIX)].split("-")
+        if int(pid) == os.getpid() or _pid_alive(int(pid)):
+            continue
+        path = os.path.join(directory, name)
+        records = read_members(path)
+        end = max((record[0] for record in records), default=int(start))
+        compact(path, os.path.join(directory, f"{start}-{end}-{pid}{SUFFIX}"))
+        sealed += 1
+    return sealed
+
+
+def _parse_name(name):
+    # (start, end or None while open) from a segment file name
+    start, end, _ = name[:-len(SUFFIX)].split("-")
+    return int(start), None if end == "open" else int(end)
+
+
+def to_epoch(value):
+    # Seconds since the epoch from a number, a datetime or an ISO string
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+class LogStore:
+    # Read side of the segmented log. start/end may be epoch seconds,
+    # datetimes or ISO strings ("2024-12-09" or "2024-12-09 21:50:43");
+    # ranges are start <= timestamp < end.
+    def __init__(self, directory=LOG_DIR):
+        self.directory = directory
+
+    def _listing(self, start, end):
+        # (first, last or None while open, path) of the segments that can
+        # hold records in the range, oldest first
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        selected = []
+        for name in names:
+            if not name.endswith(SUFFIX):
+                continue
+            first, last = _parse_name(name)
+            if end is not None and first >= end:
+                continue
+            if start is not None and last is not None and last < start:
+                continue
+            selected.append((first, last, os.path.join(self.directory, name)))
+        return sorted(selected, key=lambda entry: (entry[0], entry[2]))
+
+    def segments(self, start=None, end=None):
+        # Segment paths that can hold records in the range, oldest first
+        return [path for _, _, path in self._listing(to_epoch(start), to_epoch(end))]
+
+    def read_segment(self, path):
+        return read_members(path)
+
+    def _in_range(self, path, start, end):
+        for record in read_members(path):
+            if (start is None or record[0] >= start) and (end is None or record[0] < end):
+                yield record
+
+    def scan(self, start=None, end=None):
+        # Yields (epoch, tag, user_input, response) in time order. Segments
+        # written by different processes overlap, so they are merged; a
+        # segment is only opened once the merge reaches its first timestamp,
+        # so just the segments that overlap in time are read at once.
+        start, end = to_epoch(start), to_epoch(end)
+        heads = []
+
+        def advance(number, stream):
+            record = next(stream, None)
+            if record is not None:
+                heapq.heappush(heads, (record[0], number, record, stream))
+
+        for number, (first, _, path) in enumerate(self._listing(start, end)):
+            while heads and heads[0][0] < first:
+                _, head_number, record, stream = heapq.heappop(heads)
+                yield record
+                advance(head_number, stream)
+            advance(number, self._in_range(path, start, end))
+        while heads:
+            _, head_number, record, stream = heapq.heappop(heads)
+            yield record
+            advance(head_number, stream)
+
+    def scan_newest(self, start=None, end=None):
+        # Like scan() but newest first, reading one segment at a time from
+        # the newest. A record is only yielded once no unread segment can
+        # end after it, so memory is bounded by the segments that overlap in
+        # time rather than by the range.
+        start, end = to_epoch(start), to_epoch(end)
+        listing = sorted(self._listing(start, end), key=lambda entry: (entry[0], entry[2]), reverse=True)
+        # horizons[i]: latest possible record of the segments after i
+        horizons = [float("-inf")] * len(listing)
+        latest = float("-inf")
+        for i in range(len(listing) - 1, 0, -1):
+            last = listing[i][1]
+            latest = max(latest, float("inf") if last is None else last)
+            horizons[i - 1] = latest
+        pending = []
+        order = itertools.count()
+        for (_, _, path), horizon in zip(listing, horizons):
+            for record in self._in_range(path, start, end):
+                heapq.heappush(pending, (-record[0], next(order), record))
+            while pending and -pending[0][0] > horizon:
+                yield heapq.heappop(pending)[2]
+        while pending:
+            yield heapq.heappop(pending)[2]
+
+    def __bool__(self):
+        return bool(self.segments())
+
+    def page(self, page=0, page_size=20, start=None, end=None, query=None):
+        # Same interface as ChatHistory.page: newest first, rows as
+        # [user_input, response, timestamp]. Only the newest segments needed
+        # for the page are read; counting every record would mean reading
+        # the whole range, so total is always None.
+        query = query.casefold() if query else None
+        skip = page * page_size
+        rows = []
+        for record in self.scan_newest(start, end):
+            if query and query not in record[2].casefold() and query not in record[3].casefold():
+                continue
+            if skip:
+                skip -= 1
+                continue
+            rows.append([record[2], record[3], datetime.datetime.fromtimestamp(record[0]).strftime(TIMESTAMP_FORMAT)])
+            if len(rows) == page_size:
+                break
+        return rows, None
+
+
+def migrate_csv(csv_path=LOG_PATH, directory=LOG_DIR, batch_size=10000, **options):
+    # One-shot copy of chat_log.csv into segments. Tags are left empty; the
+    # CSV never recorded them. Returns the number of records written.
+    sink = SegmentLogSink(directory, **options)
+    batch = []
+    count = 0
+    with open(csv_path, "r", newline="", encoding="utf-8") as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        for row in reader:
+            if len(row) < 3:
+                continue
+            timestamp = time.mktime(time.strptime(row[2], TIMESTAMP_FORMAT))
+            batch.append((row[0], row[1], timestamp, None))
+            if len(batch) == batch_size:
+                sink.write(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        sink.write(batch)
+        count += len(batch)
+    sink.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate or export the segmented conversation log.")
+    parser.add_argument("--dir", default=LOG_DIR, help="segment directory")
+    parser.add_argument("--migrate", metavar="CSV", help="copy an existing chat_log.csv into segments")
+    parser.add_argument("--start", help="export records from this date or time")
+    parser.add_argument("--end", help="export records before this date or time")
+    args = parser.parse_args()
+
+    seal_stale(args.dir)
+    if args.migrate:
+        count = migrate_csv(args.migrate, args.dir)
+        print(f"migrated {count} records into {args.dir}", file=sys.stderr)
+        return 0
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["Timestamp", "Tag", "User Input", "Chatbot Response"])
+    for timestamp, tag, user_input, response in LogStore(args.dir).scan(args.start, args.end):
+        writer.writerow([datetime.datetime.fromtimestamp(timestamp).strftime(TIMESTAMP_FORMAT), tag or "", user_input, response])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
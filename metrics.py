@@ -0,0 +1,134 @@
+import os
+import bisect
+import threading
+
+# In-process metrics for the chat hot path: per-stage latency histograms and
+# event counters, rendered in the Prometheus text format (server.py serves it
+# on GET /metrics) or as a dict for the Streamlit stats page.
+#
+# Recording is a perf_counter() difference, a bisect over a dozen bucket
+# bounds and an increment under a lock, so it stays on in production.
+# CHATBOT_METRICS=0 turns recording off entirely. Each process keeps its own
+# numbers; with pre-forked workers every worker reports its own share.
+
+ENABLED = os.environ.get("CHATBOT_METRICS", "1") != "0"
+
+# Bucket upper bounds in seconds, from 10us to 10s
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+STAGE_HELP = "Time spent in each stage of handling a chat message"
+COUNTER_HELP = {
+    "requests": "Chat messages handled",
+    "cache_hits": "Classifications answered from the cache",
+    "cache_misses": "Classifications that ran the model",
+    "exact_hits": "Inputs answered from the exact pattern table",
+    "exact_misses": "Inputs not found in the exact pattern table",
+    "fallbacks": "Messages answered with the fallback response",
+    "log_rows": "Rows written to the conversation log",
+    "log_dropped": "Rows dropped because the log queue was full",
+}
+
+_stages = {}
+_counters = {name: Counter() for name in COUNTER_HELP}
+_registry_lock = threading.Lock()
+
+
+def stage(name):
+    histogram = _stages.get(name)
+    if histogram is None:
+        with _registry_lock:
+            histogram = _stages.setdefault(name, Histogram())
+    return histogram
+
+
+def observe(name, seconds):
+    if ENABLED:
+        stage(name).observe(seconds)
+
+
+def inc(name, amount=1):
+    if ENABLED:
+        _counters[name].inc(amount)
+
+
+def snapshot():
+    # Plain dict of everything recorded so far, for display
+    stages = {}
+    for name, histogram in sorted(_stages.items()):
+        stages[name] = {
+            "count": histogram.count,
+            "mean_ms": round(histogram.total / histogram.count * 1000, 4) if histogram.count else None,
+            "p50_ms": _ms(histogram.quantile(0.5)),
+            "p95_ms": _ms(histogram.quantile(0.95)),
+            "p99_ms": _ms(histogram.quantile(0.99)),
+        }
+    return {"stages": stages, "counters": {name: counter.value for name, counter in _counters.items()}}
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 4)
+
+
+def render_prometheus():
+    lines = [
+        f"# HELP chatbot_stage_seconds {STAGE_HELP}",
+        "# TYPE chatbot_stage_seconds histogram",
+    ]
+    for name, histogram in sorted(_stages.items()):
+        with histogram._lock:
+            counts = list(histogram.counts)
+            total, count = histogram.total, histogram.count
+        cumulative = 0
+        for bound, bucket_count in zip(histogram.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'chatbot_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'chatbot_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+        lines.append(f'chatbot_stage_seconds_sum{{stage="{name}"}} {total}')
+        lines.append(f'chatbot_stage_seconds_count{{stage="{name}"}} {count}')
+    for name, counter in _counters.items():
+        lines.append(f"# HELP chatbot_{name}_total {COUNTER_HELP[name]}")
+        lines.append(f"# TYPE chatbot_{name}_total counter")
+        lines.append(f"chatbot_{name}_total {counter.value}")
+    return "\n".join(lines) + "\n"
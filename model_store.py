@@ -0,0 +1,463 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bump this whenever the layout of the saved artifact changes so that old
+# artifacts are ignored instead of being loaded into the new code.
+ARTIFACT_FORMAT = 6
+
+INTENTS_PATH = os.path.abspath("./intents.json")
+MODEL_DIR = os.path.abspath(os.environ.get("CHATBOT_MODEL_DIR", "./model"))
+
+# Feature modes for the inference path:
+#   full     the original TfidfVectorizer(ngram_range=(1, 4)) + sklearn predict
+#   float32  same vocabulary, coefficients kept as a dense float32 matrix
+#   pruned   vocabulary capped at the PRUNED_MAX_FEATURES most frequent n-grams
+#   hashed   HashingVectorizer into HASHED_N_FEATURES buckets, no vocabulary
+# Every mode but "full" scores with the float32 matrix instead of sklearn.
+# `python model_store.py --report` compares their accuracy and size.
+MODEL_MODES = ("full", "float32", "pruned", "hashed")
+MODEL_MODE = os.environ.get("CHATBOT_MODEL_MODE", "full")
+PRUNED_MAX_FEATURES = 4000
+HASHED_N_FEATURES = 2 ** 12
+# Build from the previous artifact with update() instead of training from
+# scratch. Off by default: an updated model depends on which artifact it
+# started from, so the same intents.json can give different weights. Meant
+# for the edit-and-reload loop while working on intents.json, not deploys.
+INCREMENTAL = os.environ.get("CHATBOT_INCREMENTAL", "0") == "1"
+
+
+class ChatModel:
+    # Everything the inference path needs, trained once and saved together:
+    # the fitted vectorizer, the classifier and the tag -> responses table.
+    # A compact model drops the sklearn classifier and keeps only its
+    # coefficients as a contiguous float32 (n_features, n_classes) matrix.
+    # The training patterns and labels are kept so that the next intents.json
+    # can be diffed against them (see update()). `lineage` lists the versions
+    # an incrementally updated model was derived from, oldest first; it is
+    # empty for a model trained from scratch.
+    def __init__(self, vectorizer, clf, responses, version, mode="full", patterns=(), labels=()):
+        self.vectorizer = vectorizer
+        self.responses = responses
+        self.version = version
+        self.mode = mode
+        self.patterns = list(patterns)
+        self.labels = list(labels)
+        self.lineage = []
+        self.classes = [str(tag) for tag in clf.classes_]
+        if mode != "full":
+            self.clf = None
+            self.weights = np.ascontiguousarray(clf.coef_.T, dtype=np.float32)
+            self.intercept = clf.intercept_.astype(np.float32)
+        else:
+            self.clf = clf
+            self.weights = self.intercept = None
+        self.build_index()
+
+    def build_index(self):
+        # Class ids line up with clf.classes_, so a prediction goes straight
+        # from the argmax of the decision function to its responses without
+        # comparing tag strings.
+        self.tags = tuple(self.classes)
+        self.tag_index = {tag: class_id for class_id, tag in enumerate(self.tags)}
+        self.class_responses = tuple(self.responses[tag] for tag in self.tags)
+
+    def __getstate__(self):
+        # The index is cheap to derive, so it is rebuilt on load rather than
+        # stored in the artifact.
+        state = dict(self.__dict__)
+        for name in ("tags", "tag_index", "class_responses"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_index()
+
+    def decision_function(self, x):
+        if self.clf is not None:
+            return self.clf.decision_function(x)
+        return x @ self.weights + self.intercept
+
+    def predict_proba(self, x):
+        if self.clf is not None:
+            return self.clf.predict_proba(x)
+        return softmax(self.decision_function(x))
+
+    def coefficients(self):
+        # (coef, intercept) in sklearn's (n_classes, n_features) layout
+        if self.clf is not None:
+            return self.clf.coef_, self.clf.intercept_
+        return self.weights.T, self.intercept
+
+    def predict_ids(self, x):
+        # Same decision rule as clf.predict, but returns class ids
+        return self.decision_function(x).argmax(axis=1)
+
+    def transform(self, texts):
+        return self.vectorizer.transform(texts)
+
+    def classify_features(self, x):
+        proba = self.predict_proba(x)
+        return proba.argmax(axis=1), proba.max(axis=1)
+
+    def classify(self, texts):
+        # Vectorize and score all texts as one sparse matrix. Returns the
+        # class id and its probability for every text.
+        return self.classify_features(self.transform(texts))
+
+    def rank(self, texts, k):
+        # Top-k (class ids, probabilities) per text from one vectorization
+        return top_k(self.predict_proba(self.vectorizer.transform(texts)), k)
+
+    def size(self):
+        # Approximate in-memory size of the parts used for inference, in bytes
+        import pickle
+
+        if self.clf is not None:
+            weights = self.clf.coef_.nbytes + self.clf.intercept_.nbytes
+        else:
+            weights = self.weights.nbytes + self.intercept.nbytes
+        return {
+            "vectorizer": len(pickle.dumps(self.vectorizer, protocol=pickle.HIGHEST_PROTOCOL)),
+            "weights": weights,
+        }
+
+
+def softmax(scores):
+    # In place, as multinomial LogisticRegression turns scores into probabilities
+    scores -= scores.max(axis=1, keepdims=True)
+    proba = np.exp(scores, out=scores)
+    proba /= proba.sum(axis=1, keepdims=True)
+    return proba
+
+
+def top_k(proba, k):
+    # The k most likely classes per row, best first. argpartition keeps this
+    # linear in the number of classes; only the k winners get sorted.
+    k = max(1, min(k, proba.shape[1]))
+    class_ids = np.argpartition(-proba, k - 1, axis=1)[:, :k]
+    probabilities = np.take_along_axis(proba, class_ids, axis=1)
+    order = np.argsort(-probabilities, axis=1, kind="stable")
+    return np.take_along_axis(class_ids, order, axis=1), np.take_along_axis(probabilities, order, axis=1)
+
+
+def intents_hash(path=INTENTS_PATH):
+    # Hash the raw bytes so any edit to intents.json produces a new artifact key
+    digest = hashlib.sha256()
+    digest.update(f"format={ARTIFACT_FORMAT};".encode())
+    with open(path, "rb") as file:
+        digest.update(file.read())
+    return digest.hexdigest()
+
+
+def load_intents(path=INTENTS_PATH, model_dir=MODEL_DIR):
+    # Validated and deduplicated intents, one entry per tag, read from the
+    # compiled bundle (see intents_compiler.py). Raises IntentsError when
+    # intents.json has problems, so a bad edit fails the build.
+    import intents_compiler
+    return intents_compiler.load(path, model_dir).as_intents()
+
+
+def artifact_path(version, model_dir=MODEL_DIR, mode="full"):
+    suffix = "" if mode == "full" else f"-{mode}"
+    return os.path.join(model_dir, f"chatbot-{version[:16]}{suffix}.joblib")
+
+
+def make_vectorizer(mode="full"):
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer, TfidfVectorizer
+    from sklearn.pipeline import make_pipeline
+
+    if mode not in MODEL_MODES:
+        raise ValueError(f"unknown model mode {mode!r}, expected one of {', '.join(MODEL_MODES)}")
+    if mode == "full":
+        return TfidfVectorizer(ngram_range=(1, 4))
+    if mode == "hashed":
+        return make_pipeline(
+            HashingVectorizer(ngram_range=(1, 4), n_features=HASHED_N_FEATURES,
+                              alternate_sign=False, norm=None, dtype=np.float32),
+            TfidfTransformer(),
+        )
+    # float32 features so scoring against the float32 weights needs no upcast
+    max_features = PRUNED_MAX_FEATURES if mode == "pruned" else None
+    return TfidfVectorizer(ngram_range=(1, 4), max_features=max_features, dtype=np.float32)
+
+
+def training_data(intents):
+    tags = []
+    patterns = []
+    responses = {}
+    for intent in intents:
+        for pattern in intent['patterns']:
+            tags.append(intent['tag'])
+            patterns.append(pattern)
+        # The compiled intents have one entry per tag: a tag repeated in
+        # intents.json has the responses of all its entries, in file order.
+        responses[intent['tag']] = tuple(intent['responses'])
+    return patterns, tags, responses
+
+
+def train(intents, version, mode="full"):
+    from sklearn.linear_model import LogisticRegression
+
+    # Create the vectorizer and classifier
+    vectorizer = make_vectorizer(mode)
+    clf = LogisticRegression(random_state=0, max_iter=10000)
+
+    # Preprocess the data
+    patterns, tags, responses = training_data(intents)
+
+    # training the model
+    x = vectorizer.fit_transform(patterns)
+    clf.fit(x, tags)
+    return ChatModel(vectorizer, clf, responses, version, mode, patterns, tags)
+
+
+def update(model, intents, version):
+    # Incremental update of a trained model to a new intents.json.
+    #
+    # The new patterns are diffed against the ones the model was trained on.
+    # If only responses changed, the fitted vectorizer and weights are reused
+    # as they are. Otherwise the vectorizer is refit (cheap next to the
+    # classifier) and LogisticRegression is warm-started from the old
+    # coefficients, mapped onto the new vocabulary and classes with zeros for
+    # anything new. The objective is convex, so this reaches the same optimum
+    # as a full fit but needs far fewer iterations when the change is small.
+    from collections import Counter
+    from sklearn.linear_model import LogisticRegression
+
+    patterns, tags, responses = training_data(intents)
+    old_pairs = Counter(zip(model.labels, model.patterns))
+    new_pairs = Counter(zip(tags, patterns))
+    if old_pairs == new_pairs:
+        updated = ChatModel.__new__(ChatModel)
+        updated.__dict__.update(model.__getstate__())
+        updated.responses = responses
+        updated.version = version
+        updated.patterns = patterns
+        updated.labels = tags
+        updated.lineage = getattr(model, "lineage", []) + [model.version]
+        updated.build_index()
+        return updated
+
+    vectorizer = make_vectorizer(model.mode)
+    x = vectorizer.fit_transform(patterns)
+    classes = sorted(set(tags))
+
+    old_coef, old_intercept = model.coefficients()
+    coef = np.zeros((len(classes), x.shape[1]), dtype=np.float64)
+    intercept = np.zeros(len(classes), dtype=np.float64)
+    old_rows = [model.tag_index.get(tag, -1) for tag in classes]
+    new_rows = [row for row, old_row in enumerate(old_rows) if old_row >= 0]
+    old_rows = [old_row for old_row in old_rows if old_row >= 0]
+    if hasattr(vectorizer, "vocabulary_"):
+        old_vocabulary = model.vectorizer.vocabulary_
+        pairs = [(column, old_vocabulary[term]) for term, column in vectorizer.vocabulary_.items()
+                 if term in old_vocabulary]
+        new_columns = np.array([new for new, _ in pairs], dtype=np.intp)
+        old_columns = np.array([old for _, old in pairs], dtype=np.intp)
+    else:
+        # Hashed features keep their columns between fits
+        new_columns = old_columns = np.arange(x.shape[1])
+    coef[np.ix_(new_rows, new_columns)] = np.asarray(old_coef)[np.ix_(old_rows, old_columns)]
+    intercept[new_rows] = np.asarray(old_intercept)[old_rows]
+
+    clf = LogisticRegression(random_state=0, max_iter=10000, warm_start=True)
+    if len(classes) > 2:
+        # sklearn picks up coef_/intercept_ as the starting point
+        clf.coef_ = coef
+        clf.intercept_ = intercept
+    clf.fit(x, tags)
+    updated = ChatModel(vectorizer, clf, responses, version, model.mode, patterns, tags)
+    updated.lineage = getattr(model, "lineage", []) + [model.version]
+    return updated
+
+
+def previous_artifact(model_dir=MODEL_DIR, mode="full", exclude=None):
+    # Most recently written artifact of the given mode, if any
+    suffix = "" if mode == "full" else f"-{re.escape(mode)}"
+    name = re.compile(rf"chatbot-[0-9a-f]{{16}}{suffix}\.joblib")
+    candidates = []
+    if os.path.isdir(model_dir):
+        for entry in os.scandir(model_dir):
+            if name.fullmatch(entry.name) and entry.path != exclude:
+                candidates.append((entry.stat().st_mtime, entry.path))
+    return max(candidates)[1] if candidates else None
+
+
+# Hash-keyed files of one intents.json version: the model artifact of each
+# mode, the scorer's weights beside it (scorer.py) and the intents bundle
+# (intents_compiler.py)
+_VERSIONED_FILE = re.compile(r"(?:chatbot|intents)-([0-9a-f]{16})(?:-[a-z]+)?\.(?:joblib|npz|bundle)")
+
+
+def prune(keep, model_dir=MODEL_DIR):
+    # Remove the files of every version not in `keep`, so the directory does
+    # not collect one artifact set per edit of intents.json. Processes still
+    # serving a removed version keep reading their open or mapped files.
+    keep = {version[:16] for version in keep}
+    removed = []
+    if not os.path.isdir(model_dir):
+        return removed
+    # Not while a build may be reading the previous artifact
+    with open(os.path.join(model_dir, ".build.lock"), "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        for entry in os.scandir(model_dir):
+            match = _VERSIONED_FILE.fullmatch(entry.name)
+            if match and match.group(1) not in keep:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue  # pruned by another process
+                removed.append(entry.path)
+    return removed
+
+
+def save_model(model, path):
+    import joblib
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a
+    # half-written artifact.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_model(path, mmap=True):
+    import joblib
+
+    # With mmap the numpy arrays (idf weights, coefficients) are mapped from
+    # the file, so every process on the host shares the same pages.
+    return joblib.load(path, mmap_mode="r" if mmap else None)
+
+
+def build(intents_path=INTENTS_PATH, model_dir=MODEL_DIR, force=False, mode=MODEL_MODE, incremental=INCREMENTAL):
+    # Trains from scratch unless incremental is set, in which case it starts
+    # from the last artifact of the same mode when there is one. force always
+    # retrains from scratch, replacing an existing artifact.
+    version = intents_hash(intents_path)
+    path = artifact_path(version, model_dir, mode)
+    if not force and os.path.exists(path):
+        return path
+
+    os.makedirs(model_dir, exist_ok=True)
+    # One lock file for the directory rather than one per artifact
+    with open(os.path.join(model_dir, ".build.lock"), "w") as lock_file:
+        # Several workers reloading at once should only train once
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if force or not os.path.exists(path):
+            intents = load_intents(intents_path, model_dir)
+            previous = previous_artifact(model_dir, mode, exclude=path) if incremental and not force else None
+            previous_model = load_model(previous, mmap=False) if previous else None
+            if getattr(previous_model, "labels", None):
+                model = update(previous_model, intents, version)
+            else:
+                model = train(intents, version, mode)
+            save_model(model, path)
+    return path
+
+
+def load_or_build(intents_path=INTENTS_PATH, model_dir=MODEL_DIR, mode=MODEL_MODE, incremental=INCREMENTAL):
+    # Only retrain when intents.json has changed since the last build
+    version = intents_hash(intents_path)
+    path = artifact_path(version, model_dir, mode)
+    if not os.path.exists(path):
+        build(intents_path, model_dir, mode=mode, incremental=incremental)
+    model = load_model(path)
+    if getattr(model, "version", None) != version or (getattr(model, "lineage", None) and not incremental):
+        # Stale or foreign file under our name, or an incremental build where
+        # a from-scratch one is wanted: rebuild it from scratch
+        build(intents_path, model_dir, force=True, mode=mode)
+        model = load_model(path)
+    return model
+
+
+def compare_modes(intents_path=INTENTS_PATH, modes=MODEL_MODES):
+    # Accuracy-vs-size report over the patterns in intents.json. Accuracy is
+    # measured against the pattern labels; agreement is the share of patterns
+    # that get the same tag as the full model.
+    intents = load_intents(intents_path)
+    patterns = [pattern for intent in intents for pattern in intent['patterns']]
+    labels = [intent['tag'] for intent in intents for pattern in intent['patterns']]
+    version = intents_hash(intents_path)
+
+    report = []
+    reference = None
+    for mode in modes:
+        start = time.perf_counter()
+        model = train(intents, version, mode)
+        train_time = time.perf_counter() - start
+
+        class_ids, _ = model.classify(patterns)
+        predicted = [model.tags[class_id] for class_id in class_ids]
+        if reference is None:
+            reference = predicted
+
+        start = time.perf_counter()
+        for pattern in patterns:
+            model.classify([pattern])
+        request_time = (time.perf_counter() - start) / len(patterns)
+
+        size = model.size()
+        report.append({
+            "mode": mode,
+            "features": len(model.vectorizer.vocabulary_) if hasattr(model.vectorizer, "vocabulary_") else HASHED_N_FEATURES,
+            "accuracy": sum(p == l for p, l in zip(predicted, labels)) / len(labels),
+            "agreement_with_full": sum(p == r for p, r in zip(predicted, reference)) / len(reference),
+            "vectorizer_bytes": size["vectorizer"],
+            "weights_bytes": size["weights"],
+            "train_seconds": round(train_time, 3),
+            "request_us": round(request_time * 1e6, 1),
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the chatbot model and save it as an artifact.")
+    parser.add_argument("--intents", default=INTENTS_PATH, help="path to intents.json")
+    parser.add_argument("--model-dir", default=MODEL_DIR, help="directory for model artifacts")
+    parser.add_argument("--force", action="store_true", help="retrain from scratch even if an artifact already exists")
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, default=INCREMENTAL,
+                        help="update the previous artifact instead of training from scratch "
+                             "(default: on with CHATBOT_INCREMENTAL=1)")
+    parser.add_argument("--mode", choices=MODEL_MODES, default=MODEL_MODE,
+                        help="feature mode of the artifact (default: $CHATBOT_MODEL_MODE or full)")
+    parser.add_argument("--report", action="store_true", help="print an accuracy-vs-size report of all modes as JSON")
+    args = parser.parse_args()
+
+    if args.report:
+        print(json.dumps(compare_modes(args.intents), indent=2))
+        return 0
+
+    # Go through the importable module so the pickled ChatModel is recorded as
+    # model_store.ChatModel rather than __main__.ChatModel.
+    import model_store
+    import intents_compiler
+
+    start = time.perf_counter()
+    try:
+        path = model_store.build(args.intents, args.model_dir, force=args.force, mode=args.mode,
+                                 incremental=args.incremental)
+    except intents_compiler.IntentsError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    print(f"{path} ({time.perf_counter() - start:.2f}s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+import os
+import sys
+import time
+import atexit
+import random
+import pstats
+import marshal
+import argparse
+import cProfile
+import datetime
+import functools
+import threading
+
+# On-demand request profiling for the chat path.
+#
+# Functions wrapped with @profiled(name) (chatbot.reply, chatbot_batch and
+# the ChatLogger log/write path) run under cProfile for a sampled share of
+# calls:
+#
+#   CHATBOT_PROFILE_RATE=0.05 streamlit run chatbot.py
+#
+# profiles every twentieth call on average; the Stats page has the same
+# setting in the sidebar, which changes it for the whole process at runtime.
+# The rate defaults to 0, and then a wrapped call costs one global lookup and
+# a comparison on top of the plain call.
+#
+# A sampled call writes its own profile to
+# CHATBOT_PROFILE_DIR/requests/<time>-<pid>-<seq>-<name>.prof, readable with
+# pstats or snakeviz, up to CHATBOT_PROFILE_MAX_FILES per process. Every
+# sampled call is also added to a per-process aggregate, which is written at
+# most every FLUSH_SECONDS and at exit (server.py workers, which leave with
+# os._exit, flush before they do) as <name>-<pid>.prof plus
+# stacks-<pid>.folded, one "frame;frame;frame microseconds" line per stack,
+# the input flamegraph.pl and speedscope take. cProfile only records caller
+# and callee pairs, so the stacks are rebuilt from those: a function called
+# from several places has its time split between them in proportion to the
+# time spent under each caller.
+#
+#   python profiling.py [--dir profiles] [--top 25]
+#
+# merges the aggregates of all processes into stacks.folded and prints the
+# functions with the most cumulative time.
+
+PROFILE_DIR = os.environ.get("CHATBOT_PROFILE_DIR", "profiles")
+MAX_FILES = int(os.environ.get("CHATBOT_PROFILE_MAX_FILES", "1000"))
+FLUSH_SECONDS = 10.0
+# Stacks below this many microseconds are left out of the folded output
+MIN_STACK_US = 1
+
+_rate = float(os.environ.get("CHATBOT_PROFILE_RATE", "0"))
+_local = threading.local()
+_lock = threading.Lock()
+# Serializes flush() calls, which write the same files
+_flush_lock = threading.Lock()
+_aggregates = {}
+_sampled = 0
+_files = 0
+_last_flush = time.monotonic()
+
+
+def rate():
+    return _rate
+
+
+def set_rate(value):
+    # Share of wrapped calls to profile from now on, 0 turns profiling off
+    global _rate
+    _rate = min(max(float(value), 0.0), 1.0)
+
+
+def profiled(name):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _rate and random.random() < _rate and not getattr(_local, "active", False):
+                return _capture(name, func, args, kwargs)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _capture(name, func, args, kwargs):
+    global _sampled, _files
+    profile = cProfile.Profile()
+    _local.active = True
+    try:
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (a debugger, coverage) owns this thread
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with _lock:
+                _sampled += 1
+                seq = _sampled
+                write = _files < MAX_FILES
+                if write:
+                    _files += 1
+            try:
+                _record(name, profile, seq, write)
+            except OSError as exc:
+                print(f"profiling: failed to write a {name} profile: {exc!r}", file=sys.stderr)
+    finally:
+        _local.active = False
+
+
+def _record(name, profile, seq, write):
+    global _last_flush
+    if write:
+        directory = os.path.join(PROFILE_DIR, "requests")
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")
+        profile.dump_stats(os.path.join(directory, f"{stamp}-{os.getpid()}-{seq}-{name}.prof"))
+    with _lock:
+        stats = _aggregates.get(name)
+        if stats is None:
+            _aggregates[name] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        due = time.monotonic() - _last_flush >= FLUSH_SECONDS
+        if due:
+            _last_flush = time.monotonic()
+    if due:
+        flush()
+
+
+def _label(func):
+    filename, line, function = func
+    if filename == "~":
+        # Built-ins: "<built-in method time.perf_counter>"
+        return function.replace(";", ",")
+    return f"{os.path.basename(filename)}:{line}({function})".replace(";", ",")
+
+
+def folded_stacks(table, root=None):
+    # {"frame;frame;...": microseconds} from a pstats table (Stats.stats)
+    callees = {}
+    for func, (_, _, _, _, callers) in table.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    folded = {}
+
+    def walk(func, path, on_path, share):
+        frames = path + (_label(func),)
+        self_us = table[func][2] * share * 1e6
+        if self_us >= MIN_STACK_US:
+            key = ";".join(frames)
+            folded[key] = folded.get(key, 0) + self_us
+        for callee, edge_time in callees.get(func, ()):
+            total = table[callee][3]
+            # Skip recursion and subtrees too small to show
+            if callee in on_path or total <= 0 or share * edge_time * 1e6 < MIN_STACK_US:
+                continue
+            walk(callee, frames, on_path | {callee}, share * edge_time / total)
+
+    prefix = (root,) if root else ()
+    for func, (_, _, _, _, callers) in table.items():
+        if not callers and "_lsprof.Profiler" not in func[2]:
+            walk(func, prefix, frozenset((func,)), 1.0)
+    return {key: round(us) for key, us in folded.items() if round(us) > 0}
+
+
+def write_folded(folded, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        for key, us in sorted(folded.items()):
+            file.write(f"{key} {us}\n")
+    os.replace(tmp_path, path)
+
+
+def flush():
+    # Write this process's aggregates; called every FLUSH_SECONDS, at exit
+    # and by server.py workers before they exit. Only the copy of the tables
+    # is taken under the lock, so sampled requests are not held up by the
+    # file writes.
+    with _lock:
+        tables = [(name, dict(stats.stats)) for name, stats in _aggregates.items()]
+    if not tables:
+        return
+    with _flush_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        pid = os.getpid()
+        folded = {}
+        for name, table in tables:
+            path = os.path.join(PROFILE_DIR, f"{name}-{pid}.prof")
+            # What pstats.Stats.dump_stats writes
+            with open(f"{path}.tmp", "wb") as file:
+                marshal.dump(table, file)
+            os.replace(f"{path}.tmp", path)
+            folded.update(folded_stacks(table, root=name))
+        write_folded(folded, os.path.join(PROFILE_DIR, f"stacks-{pid}.folded"))
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError as exc:
+        print(f"profiling: failed to write the aggregate profiles: {exc!r}", file=sys.stderr)
+
+
+def stats():
+    with _lock:
+        return {
+            "rate": _rate,
+            "sampled": _sampled,
+            "files": _files,
+            "max_files": MAX_FILES,
+            "directory": os.path.abspath(PROFILE_DIR),
+        }
+
+
+def _reset_after_fork():
+    # A forked worker profiles and writes its own share under its own pid
+    global _lock, _flush_lock, _aggregates, _sampled, _files
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _aggregates = {}
+    _sampled = 0
+    _files = 0
+
+
+atexit.register(_flush_at_exit)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the aggregate profiles of all chatbot processes.")
+    parser.add_argument("--dir", default=PROFILE_DIR, help="profile directory")
+    parser.add_argument("--top", type=int, default=25, help="functions to print per profiled name")
+    args = parser.parse_args()
+
+    by_name = {}
+    for entry in sorted(os.listdir(args.dir)) if os.path.isdir(args.dir) else ():
+        name, _, rest = entry.rpartition("-")
+        if entry.endswith(".prof") and rest[:-len(".prof")].isdigit():
+            by_name.setdefault(name, []).append(os.path.join(args.dir, entry))
+    if not by_name:
+        print(f"no aggregate profiles in {args.dir}", file=sys.stderr)
+        return 1
+
+    folded = {}
+    for name, paths in sorted(by_name.items()):
+        stats = pstats.Stats(*paths, stream=sys.stdout)
+        print(f"== {name}: {len(paths)} process(es)")
+        stats.sort_stats("cumulative").print_stats(args.top)
+        for key, us in folded_stacks(stats.stats, root=name).items():
+            folded[key] = folded.get(key, 0) + us
+    path = os.path.join(args.dir, "stacks.folded")
+    write_folded(folded, path)
+    print(f"{path}: {len(folded)} stacks", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
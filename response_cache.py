@@ -0,0 +1,71 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+_NON_WORD = re.compile(r"\W+")
+
+
+def normalize_text(text):
+    # The vectorizer lowercases and only keeps runs of word characters, so
+    # folding case and collapsing everything else to single spaces gives the
+    # same features while letting "Hi", "hi!" and " HI " share one entry.
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+class ClassificationCache:
+    # Bounded LRU cache of classification results keyed on normalized input.
+    # Entries belong to one model version; asking with a different version
+    # (new artifact or edited intents.json) drops everything cached so far.
+    def __init__(self, maxsize=4096, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "version": self.version,
+            }
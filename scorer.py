@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import model_store
+
+# Standalone scorer for serving without scikit-learn.
+#
+# export() copies out of a fitted ChatModel everything that
+# TfidfVectorizer.transform and the linear classifier use: the lowercasing
+# and token regex, the n-gram range, the vocabulary, the idf weights and the
+# coefficient matrix. NumpyScorer reproduces transform + argmax with NumPy
+# alone and has the same classify() interface as ChatModel, so chatbot.py can
+# use either one (CHATBOT_ENGINE=numpy). `python scorer.py --verify` checks
+# that both give the same tag for every pattern in intents.json.
+
+class NumpyScorer:
+    def __init__(self, arrays):
+        self.version = str(arrays["version"])
+        self.token_pattern = re.compile(str(arrays["token_pattern"]))
+        self.lowercase = bool(arrays["lowercase"])
+        self.min_n, self.max_n = (int(n) for n in arrays["ngram_range"])
+        self.vocabulary = {str(term): column for column, term in enumerate(arrays["terms"])}
+        self.idf = arrays["idf"]
+        self.weights = arrays["weights"]
+        self.intercept = arrays["intercept"]
+        self.tags = tuple(str(tag) for tag in arrays["tags"])
+        self.tag_index = {tag: class_id for class_id, tag in enumerate(self.tags)}
+        responses = json.loads(str(arrays["responses"]))
+        self.class_responses = tuple(tuple(responses[tag]) for tag in self.tags)
+
+    def _features(self, text):
+        # Same steps as TfidfVectorizer: lowercase, tokenize, word n-grams,
+        # raw counts times idf, then l2 normalization
+        if self.lowercase:
+            text = text.lower()
+        tokens = self.token_pattern.findall(text)
+        counts = {}
+        for n in range(self.min_n, min(self.max_n, len(tokens)) + 1):
+            for start in range(len(tokens) - n + 1):
+                column = self.vocabulary.get(" ".join(tokens[start:start + n]))
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+        columns = np.fromiter(sorted(counts), dtype=np.intp, count=len(counts))
+        values = np.array([counts[column] for column in columns], dtype=self.idf.dtype) * self.idf[columns]
+        norm = np.sqrt(np.dot(values, values))
+        if norm > 0:
+            values /= norm
+        return columns, values
+
+    def transform(self, texts):
+        return [self._features(text) for text in texts]
+
+    def _scores(self, features):
+        scores = np.empty((len(features), len(self.tags)), dtype=self.weights.dtype)
+        for row, (columns, values) in enumerate(features):
+            scores[row] = values @ self.weights[columns] + self.intercept
+        return scores
+
+    def decision_function(self, texts):
+        return self._scores(self.transform(texts))
+
+    def predict_proba(self, texts):
+        return model_store.softmax(self.decision_function(texts))
+
+    def predict_ids(self, texts):
+        return self.decision_function(texts).argmax(axis=1)
+
+    def classify_features(self, features):
+        proba = model_store.softmax(self._scores(features))
+        return proba.argmax(axis=1), proba.max(axis=1)
+
+    def classify(self, texts):
+        return self.classify_features(self.transform(texts))
+
+    def rank(self, texts, k):
+        return model_store.top_k(self.predict_proba(texts), k)
+
+
+def scorer_path(version, model_dir=model_store.MODEL_DIR, mode=model_store.MODEL_MODE):
+    return model_store.artifact_path(version, model_dir, mode)[:-len(".joblib")] + ".npz"
+
+
+def export(model, path):
+    vectorizer = model.vectorizer
+    if not hasattr(vectorizer, "vocabulary_"):
+        raise ValueError("only vocabulary based modes can be exported, not 'hashed'")
+    if vectorizer.analyzer != "word" or vectorizer.sublinear_tf or vectorizer.norm != "l2" \
+            or vectorizer.strip_accents or vectorizer.stop_words or vectorizer.preprocessor or vectorizer.tokenizer:
+        raise ValueError("the scorer only reproduces the TfidfVectorizer settings model_store uses")
+
+    terms = np.empty(len(vectorizer.vocabulary_), dtype=object)
+    for term, column in vectorizer.vocabulary_.items():
+        terms[column] = term
+    if model.clf is not None:
+        weights = np.ascontiguousarray(model.clf.coef_.T)
+        intercept = model.clf.intercept_
+    else:
+        weights, intercept = model.weights, model.intercept
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        version=np.array(model.version),
+        token_pattern=np.array(vectorizer.token_pattern),
+        lowercase=np.array(vectorizer.lowercase),
+        ngram_range=np.array(vectorizer.ngram_range),
+        terms=terms.astype(str),
+        idf=vectorizer.idf_.astype(weights.dtype),
+        weights=weights,
+        intercept=np.asarray(intercept, dtype=weights.dtype),
+        tags=np.array(model.tags),
+        responses=np.array(json.dumps({tag: list(responses) for tag, responses in zip(model.tags, model.class_responses)})),
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+def load(path):
+    with np.load(path, allow_pickle=False) as arrays:
+        return NumpyScorer({name: arrays[name] for name in arrays.files})
+
+
+def load_or_export(intents_path=model_store.INTENTS_PATH, model_dir=model_store.MODEL_DIR, mode=model_store.MODEL_MODE):
+    # scikit-learn is only needed when the exported scorer is missing or stale
+    version = model_store.intents_hash(intents_path)
+    path = scorer_path(version, model_dir, mode)
+    if os.path.exists(path):
+        scorer = load(path)
+        if scorer.version == version:
+            return scorer
+    export(model_store.load_or_build(intents_path, model_dir, mode), path)
+    return load(path)
+
+
+def verify(model, scorer, texts):
+    # Texts for which the scorer and the sklearn model disagree on the tag
+    expected = model.predict_ids(model.vectorizer.transform(texts))
+    actual = scorer.predict_ids(texts)
+    return [(text, model.tags[e], scorer.tags[a]) for text, e, a in zip(texts, expected, actual) if e != a]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the chatbot model to a NumPy-only scorer.")
+    parser.add_argument("--intents", default=model_store.INTENTS_PATH, help="path to intents.json")
+    parser.add_argument("--model-dir", default=model_store.MODEL_DIR, help="directory for model artifacts")
+    parser.add_argument("--mode", choices=("full", "float32", "pruned"), default=model_store.MODEL_MODE)
+    parser.add_argument("--verify", action="store_true",
+                        help="check that the scorer predicts the same tag as the model for every pattern")
+    args = parser.parse_args()
+
+    model = model_store.load_or_build(args.intents, args.model_dir, args.mode)
+    path = export(model, scorer_path(model.version, args.model_dir, args.mode))
+    print(path)
+
+    if args.verify:
+        intents = model_store.load_intents(args.intents)
+        patterns = [pattern for intent in intents for pattern in intent['patterns']]
+        mismatches = verify(model, load(path), patterns)
+        for text, expected, actual in mismatches:
+            print(f"mismatch: {text!r}: model {expected!r}, scorer {actual!r}", file=sys.stderr)
+        print(f"{len(patterns) - len(mismatches)}/{len(patterns)} patterns agree")
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,441 @@
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import chatbot
+import metrics
+import profiling
+from chat_logger import get_logger
+from hot_reload import start_watcher
+
+MAX_BODY_BYTES = 1024 * 1024
+MAX_BATCH_SIZE = 1000
+# A worker that exits sooner than this after starting counts as a crash loop:
+# its replacement is delayed, doubling from 0.5 s up to 30 s
+RESTART_WINDOW = 10.0
+RESTART_DELAY_MAX = 30.0
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def process_memory():
+    # Resident (rss), proportional (pss) and private memory of this process in
+    # kB. With pre-forked workers pss/private show how much of the model is
+    # really shared; only available on Linux.
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name.lower()] = int(value.split()[0])
+    except OSError:
+        return memory
+    memory['private'] = memory.pop('private_clean', 0) + memory.pop('private_dirty', 0)
+    return memory
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class LatencyWindow:
+    # Latencies of the most recent requests, for the percentiles in /health
+    def __init__(self, size=10000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentiles(self, points=(50, 95, 99)):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {f"p{point}": None for point in points}
+        return {
+            f"p{point}": round(ordered[min(len(ordered) - 1, len(ordered) * point // 100)] * 1000, 3)
+            for point in points
+        }
+
+
+class ChatServer:
+    # Minimal HTTP/1.1 JSON service around the chat model.
+    #
+    #   POST /chat        {"text": "...", "top_k": 3} -> {"tag", "probability", "response", "top_k"}
+    #   POST /chat/batch  {"texts": ["...", ...]}     -> {"results": [...]}
+    #   GET  /health                                  -> status, model version, latency percentiles
+    #   GET  /metrics                                 -> per-stage histograms, Prometheus text format
+    #
+    # "top_k" is optional and adds the k most likely tags with their
+    # probabilities to the answer.
+    #
+    # Predictions run on a thread pool so the event loop keeps accepting
+    # connections. At most max_pending predictions may be queued or running;
+    # beyond that requests are refused with 503, and a prediction that takes
+    # longer than `timeout` seconds is answered with 504.
+    def __init__(self, workers=4, max_pending=64, timeout=5.0, log=True):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-worker")
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.log = log
+        self.pending = 0
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency = LatencyWindow()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as exc:
+                    await self._send(writer, exc.status, {"error": exc.message}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+                start = time.perf_counter()
+                try:
+                    status, payload = 200, await self.dispatch(method, path, body)
+                except HTTPError as exc:
+                    status, payload = exc.status, {"error": exc.message}
+                except Exception as exc:
+                    status, payload = 500, {"error": repr(exc)}
+                self.requests += 1
+                if status >= 500:
+                    self.errors += 1
+                elapsed = time.perf_counter() - start
+                self.latency.add(elapsed)
+                metrics.observe("http_request", elapsed)
+                await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _readline(self, reader):
+        # A line longer than the stream limit (64 KiB) raises ValueError
+        try:
+            return await reader.readline()
+        except ValueError:
+            raise HTTPError(431, "request line or header too long")
+
+    async def _read_request(self, reader):
+        request_line = await self._readline(reader)
+        if not request_line:
+            return None
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+
+        headers = {}
+        while True:
+            line = await self._readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(400, "invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b''
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        return method, path.split('?', 1)[0], body, keep_alive
+
+    async def _send(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = "text/plain; version=0.0.4"
+        else:
+            body = json.dumps(payload).encode('utf-8')
+            content_type = "application/json"
+        head = (
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def dispatch(self, method, path, body):
+        if path == '/health':
+            if method != 'GET':
+                raise HTTPError(405, "use GET")
+            return self.health()
+        if path == '/metrics':
+            if method != 'GET':
+                raise HTTPError(405, "use GET")
+            return metrics.render_prometheus()
+        if path in ('/chat', '/chat/batch'):
+            if method != 'POST':
+                raise HTTPError(405, "use POST")
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                raise HTTPError(400, "body is not valid JSON")
+            if path == '/chat':
+                text = data.get('text') if isinstance(data, dict) else None
+                if not isinstance(text, str):
+                    raise HTTPError(400, "expected {\"text\": \"...\"}")
+                k = data.get('top_k')
+                if k is not None and (not isinstance(k, int) or isinstance(k, bool) or k < 1):
+                    raise HTTPError(400, "top_k must be a positive integer")
+                return await self.run(self.chat, text, k)
+            texts = data.get('texts') if isinstance(data, dict) else None
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise HTTPError(400, "expected {\"texts\": [\"...\", ...]}")
+            if len(texts) > MAX_BATCH_SIZE:
+                raise HTTPError(413, f"at most {MAX_BATCH_SIZE} texts per batch")
+            return await self.run(self.chat_batch, texts)
+        raise HTTPError(404, "not found")
+
+    async def run(self, function, *arguments):
+        # Backpressure: refuse work rather than queue it without bound
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPError(503, "server busy")
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(function, *arguments)
+        self.pending += 1
+        # The slot is held until the prediction has finished, not just until
+        # this request stops waiting for it: a timed out prediction keeps its
+        # executor thread busy
+        future.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(504, "prediction timed out")
+
+    def _release(self, loop):
+        # Runs on the executor thread; pending is only touched on the loop
+        def release():
+            self.pending -= 1
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:
+            pass  # the loop is closed, the server is shutting down
+
+    def chat(self, text, k=None):
+        if k is None:
+            tag, probability, response = chatbot.reply(text)
+            result = {"tag": tag, "probability": probability, "response": response}
+        else:
+            tag, probability, response, candidates = chatbot.get_response(text, k)
+            result = {
+                "tag": tag,
+                "probability": probability,
+                "response": response,
+                "top_k": [{"tag": t, "probability": p} for t, p in candidates],
+            }
+        if self.log:
+            get_logger().log(text, response, tag=tag)
+        return result
+
+    def chat_batch(self, texts):
+        results = []
+        for text, (tag, probability, response) in zip(texts, chatbot.chatbot_batch(texts)):
+            if self.log:
+                get_logger().log(text, response, tag=tag)
+            results.append({"tag": tag, "probability": probability, "response": response})
+        return {"results": results}
+
+    def health(self):
+        return {
+            "status": "ok",
+            "pid": os.getpid(),
+            "model_version": chatbot.model.version,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "pending": self.pending,
+            "latency_ms": self.latency.percentiles(),
+            "cache": chatbot.cache.stats(),
+            "exact_match": chatbot.exact.stats(),
+            "memory_kb": process_memory(),
+        }
+
+
+async def serve(host=None, port=None, sock=None, **options):
+    server = ChatServer(**options)
+    if sock is not None:
+        listener = await asyncio.start_server(server.handle_connection, sock=sock)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host, port)
+
+    # Stop cleanly on SIGTERM/SIGINT so queued log rows are written out
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    # Reload when intents.json changes (see hot_reload.py), or on SIGHUP
+    start_watcher()
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.run_in_executor(None, reload_model))
+    async with listener:
+        await stop.wait()
+
+
+def reload_model():
+    try:
+        new_model = chatbot.reload_model()
+        print(f"[{os.getpid()}] serving model {new_model.version[:16]}", file=sys.stderr)
+    except Exception as exc:
+        print(f"[{os.getpid()}] model reload failed, keeping the current one: {exc!r}", file=sys.stderr)
+
+
+def _run_worker(sock, options):
+    status = 0
+    try:
+        asyncio.run(serve(sock=sock, **options))
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        print(f"[{os.getpid()}] worker failed:", file=sys.stderr)
+        traceback.print_exc()
+        status = 1
+    finally:
+        # A second SIGTERM must not cut the final log flush short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        get_logger().close()
+        # os._exit skips atexit, where the profile aggregates are written
+        try:
+            profiling.flush()
+        except OSError as exc:
+            print(f"[{os.getpid()}] failed to write the profile aggregates: {exc!r}", file=sys.stderr)
+        os._exit(status)
+
+
+def serve_prefork(host, port, processes, **options):
+    # The parent loads the model (importing chatbot already did) and binds the
+    # socket, then forks the workers. The numpy arrays of the artifact are
+    # memory-mapped and the vocabulary and other Python objects are moved to
+    # the permanent generation with gc.freeze(), so the workers share them
+    # copy-on-write instead of each holding a private copy.
+    sock = socket.create_server((host, port), backlog=1024)
+    chatbot.model.classify(["warm up"])
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+    stopping = False
+    failures = 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(sock, options)
+        children[pid] = time.monotonic()
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward_reload(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(processes):
+        spawn()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, forward_reload)
+    print(f"Serving on http://{host}:{port} with {processes} worker processes")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if not stopping:
+            # A worker died on its own, replace it; right away if it had been
+            # serving for a while, after a growing delay if it keeps dying
+            # straight after startup
+            if started is not None and time.monotonic() - started < RESTART_WINDOW:
+                failures += 1
+            else:
+                failures = 0
+            delay = min(0.5 * 2 ** (failures - 1), RESTART_DELAY_MAX) if failures else 0
+            print(f"worker {pid} exited with status {status}, restarting in {delay:g} s", file=sys.stderr)
+            if delay:
+                time.sleep(delay)
+            if not stopping:
+                spawn()
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the chatbot over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--processes", type=int, default=int(os.environ.get("CHATBOT_PROCESSES", "1")),
+                        help="pre-forked worker processes sharing one loaded model (default: $CHATBOT_PROCESSES or 1)")
+    parser.add_argument("--workers", type=int, default=4, help="prediction threads per process")
+    parser.add_argument("--max-pending", type=int, default=64, help="queued predictions before answering 503")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a prediction is answered with 504")
+    parser.add_argument("--no-log", action="store_true", help="do not write conversations to the chat log")
+    args = parser.parse_args()
+
+    options = dict(
+        workers=args.workers,
+        max_pending=args.max_pending,
+        timeout=args.timeout,
+        log=not args.no_log,
+    )
+    if args.processes > 1:
+        if not hasattr(os, "fork"):
+            parser.error("--processes needs os.fork, which this platform does not have")
+        serve_prefork(args.host, args.port, args.processes, **options)
+    else:
+        print(f"Serving on http://{args.host}:{args.port}")
+        asyncio.run(serve(args.host, args.port, **options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import itertools
+import multiprocessing
+
+import model_store
+
+# Cross-validated evaluation and hyperparameter search for the intent model.
+#
+#   python tuning.py [--folds 3] [--processes 8] [--min-accuracy 0.5] [--output tuning.json]
+#
+# Every candidate (n-gram range, min_df, C, solver) is scored with stratified
+# k-fold cross-validation over the intents.json patterns, then trained once on
+# all of them to measure what serving it would cost: training time, model
+# size and single-request latency, the same numbers `model_store.py --report`
+# gives per mode. Candidates run in parallel in a process pool.
+#
+# The folds are vectorized once per (n-gram range, min_df) in the parent
+# before the pool starts; the workers inherit them and only fit classifiers.
+# With --min-accuracy the fastest candidate that reaches it is picked.
+
+GRID = {
+    "ngram_range": [(1, 1), (1, 2), (1, 3), (1, 4)],
+    "min_df": [1, 2],
+    # saga needs minutes per fit above C=30 on these features
+    "C": [1.0, 10.0, 30.0],
+    "solver": ["lbfgs", "newton-cg", "saga"],
+}
+# What model_store.train() uses today
+CURRENT = {"ngram_range": (1, 4), "min_df": 1, "C": 1.0, "solver": "lbfgs"}
+# Patterns timed one at a time for the request latency
+LATENCY_SAMPLE = 200
+
+
+def vectorized_folds(patterns, labels, ngram_range, min_df, folds, seed=0):
+    # [(x_train, x_test, y_train, y_test)], one vectorizer fitted per fold
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.model_selection import StratifiedKFold
+
+    splits = []
+    splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    with warnings.catch_warnings():
+        # Most tags have three patterns, fewer than some folds ask for
+        warnings.simplefilter("ignore", UserWarning)
+        indices = list(splitter.split(patterns, labels))
+    for train_index, test_index in indices:
+        vectorizer = TfidfVectorizer(ngram_range=ngram_range, min_df=min_df)
+        x_train = vectorizer.fit_transform([patterns[i] for i in train_index])
+        x_test = vectorizer.transform([patterns[i] for i in test_index])
+        splits.append((x_train, x_test, [labels[i] for i in train_index], [labels[i] for i in test_index]))
+    return splits
+
+
+# Vectorized folds by (ngram_range, min_df), shared with forked workers
+_folds = {}
+
+
+def _init_worker(folds):
+    global _folds
+    _folds = folds
+
+
+def evaluate(candidate, intents, patterns):
+    from sklearn.exceptions import ConvergenceWarning
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    def classifier():
+        return LogisticRegression(C=candidate["C"], solver=candidate["solver"], random_state=0, max_iter=10000)
+
+    correct = total = 0
+    fit_times = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        for x_train, x_test, y_train, y_test in _folds[(candidate["ngram_range"], candidate["min_df"])]:
+            clf = classifier()
+            start = time.perf_counter()
+            clf.fit(x_train, y_train)
+            fit_times.append(time.perf_counter() - start)
+            correct += sum(p == y for p, y in zip(clf.predict(x_test), y_test))
+            total += len(y_test)
+
+        # Fit on every pattern, as model_store.train() does, for the serving costs
+        start = time.perf_counter()
+        vectorizer = TfidfVectorizer(ngram_range=candidate["ngram_range"], min_df=candidate["min_df"])
+        train_patterns, tags, responses = model_store.training_data(intents)
+        clf = classifier().fit(vectorizer.fit_transform(train_patterns), tags)
+        train_time = time.perf_counter() - start
+    # Only kept for introspection, and it would dominate the pickled size
+    vectorizer.stop_words_ = None
+    model = model_store.ChatModel(vectorizer, clf, responses, "tuning")
+
+    # Best of three passes, since the other workers compete for the CPU
+    sample = patterns[:LATENCY_SAMPLE]
+    request_time = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for pattern in sample:
+            model.classify([pattern])
+        elapsed = (time.perf_counter() - start) / len(sample)
+        request_time = elapsed if request_time is None else min(request_time, elapsed)
+
+    size = model.size()
+    return {
+        "ngram_range": list(candidate["ngram_range"]),
+        "min_df": candidate["min_df"],
+        "C": candidate["C"],
+        "solver": candidate["solver"],
+        "accuracy": round(correct / total, 4),
+        "fold_fit_seconds": round(sum(fit_times) / len(fit_times), 3),
+        "train_seconds": round(train_time, 3),
+        "features": len(vectorizer.vocabulary_),
+        "model_bytes": size["vectorizer"] + size["weights"],
+        "request_us": round(request_time * 1e6, 1),
+    }
+
+
+def candidates(grid=GRID):
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def search(intents_path=model_store.INTENTS_PATH, grid=GRID, folds=3, processes=None):
+    intents = model_store.load_intents(intents_path)
+    patterns, labels, _ = model_store.training_data(intents)
+    todo = candidates(grid)
+
+    folds_by_key = {}
+    for ngram_range, min_df in itertools.product(grid["ngram_range"], grid["min_df"]):
+        folds_by_key[(ngram_range, min_df)] = vectorized_folds(patterns, labels, ngram_range, min_df, folds)
+
+    processes = processes or os.cpu_count() or 1
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(folds_by_key,)) as pool:
+            tasks = [(candidate, intents, patterns) for candidate in todo]
+            results = pool.starmap(evaluate, tasks, chunksize=1)
+    else:
+        _init_worker(folds_by_key)
+        results = [evaluate(candidate, intents, patterns) for candidate in todo]
+    return sorted(results, key=lambda result: (-result["accuracy"], result["request_us"]))
+
+
+def pick(results, min_accuracy):
+    # Fastest candidate at or above the accuracy bar, by request latency and
+    # then training time
+    eligible = [result for result in results if result["accuracy"] >= min_accuracy]
+    return min(eligible, key=lambda result: (result["request_us"], result["train_seconds"]), default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validated hyperparameter search for the intent model.")
+    parser.add_argument("--intents", default=model_store.INTENTS_PATH, help="path to intents.json")
+    parser.add_argument("--folds", type=int, default=3, help="number of stratified folds")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--min-accuracy", type=float, help="pick the fastest candidate with at least this accuracy")
+    parser.add_argument("--current-only", action="store_true", help="only evaluate the settings in use today")
+    parser.add_argument("--output", help="write the JSON results to this file as well")
+    args = parser.parse_args()
+
+    grid = {name: [value] for name, value in CURRENT.items()} if args.current_only else GRID
+    results = search(args.intents, grid, args.folds, args.processes)
+    report = {"folds": args.folds, "current": CURRENT, "results": results}
+    if args.min_accuracy is not None:
+        report["pick"] = pick(results, args.min_accuracy)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + "\n")
+    if args.min_accuracy is not None and report["pick"] is None:
+        print(f"no candidate reaches accuracy {args.min_accuracy}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())